@@ -0,0 +1,425 @@
+"""Offline benchmark for the forwarder, the broadcast engine and the destination menu.
+
+Runs the real handlers from main.py against a fake Pyrogram client (configurable latency,
+FloodWait and error injection), an in-process Mongo stand-in (mongomock-motor) and an
+in-memory outbox, so no bot token or database is needed:
+
+    pip install -r requirements.txt mongomock-motor
+    python bench.py
+
+Every run prints posts/s (users/s for broadcasts), p50/p99 latency and peak traced memory.
+Telegram's rate limits are lifted unless --telegram-limits is given, so the numbers show the
+bot's own overhead rather than the 30 msg/s ceiling. Outbox claims cost about what an index
+lookup does, so they do not hide the bot's overhead; Mongo round trips are not simulated.
+"""
+import os
+import gc
+import heapq
+import sys
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import tracemalloc
+from types import SimpleNamespace
+from collections import Counter
+
+# main.py reads these at import time; nothing connects until the bot is started
+os.environ.setdefault("MONGO_DB_URL", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("AUTH_CHANNEL", "")
+
+try:
+    from mongomock_motor import AsyncMongoMockClient
+except ImportError:
+    sys.exit("bench.py needs mongomock-motor: pip install mongomock-motor")
+
+from bson import ObjectId
+from pyrogram import raw
+from pyrogram.enums import ChatType, ChatMemberStatus
+from pyrogram.errors import FloodWait, InternalServerError
+
+import main as bot
+
+SOURCE_BASE = -1001000000000
+DEST_BASE = -1002000000000
+
+
+# ---------- Fake Telegram client ----------
+class FakeClient:
+    def __init__(self, latency=0.05, flood_rate=0.0, flood_seconds=1, error_rate=0.0, seed=1):
+        self.me = SimpleNamespace(id=1, username="bench_bot", first_name="Bench")
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.delivered = Counter()  # (source, message_id) -> copies that arrived
+        self.last_delivery = {}  # (source, message_id) -> monotonic time of the last copy
+        self.next_id = itertools.count(1)
+
+    async def _rpc(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        roll = self.rng.random()
+        if roll < self.flood_rate:
+            raise FloodWait(value=self.flood_seconds)
+        if roll < self.flood_rate + self.error_rate:
+            raise InternalServerError("injected by bench")
+
+    def _message(self, chat_id):
+        return SimpleNamespace(id=next(self.next_id), chat=SimpleNamespace(id=chat_id))
+
+    def _deliver(self, from_chat_id, message_id):
+        key = (from_chat_id, message_id)
+        self.delivered[key] += 1
+        self.last_delivery[key] = time.monotonic()
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._rpc("copy_message")
+        self._deliver(from_chat_id, message_id)
+        return self._message(chat_id)
+
+    async def copy_media_group(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._rpc("copy_media_group")
+        self._deliver(from_chat_id, message_id)
+        return [self._message(chat_id)]
+
+    # hidden batch forwards go through the raw API
+    def rnd_id(self):
+        return self.rng.getrandbits(63)
+
+    async def resolve_peer(self, peer_id):
+        return peer_id
+
+    async def invoke(self, query):
+        if not isinstance(query, raw.functions.messages.ForwardMessages):
+            raise NotImplementedError(type(query).__name__)
+        await self._rpc("forward_messages")
+        updates = []
+        for message_id, random_id in zip(query.id, query.random_id):
+            self._deliver(query.from_peer, message_id)
+            updates.append(raw.types.UpdateMessageID(id=next(self.next_id), random_id=random_id))
+        return SimpleNamespace(updates=updates)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._rpc("send_message")
+        return self._message(chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._rpc("edit_message_text")
+
+    async def get_chat(self, chat_id):
+        await self._rpc("get_chat")
+        return SimpleNamespace(id=chat_id, title=f"Chat {chat_id}", type=ChatType.CHANNEL, invite_link=None)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._rpc("get_chat_member")
+        return SimpleNamespace(status=ChatMemberStatus.ADMINISTRATOR)
+
+
+class FakeText(str):
+    @property
+    def html(self):
+        return str(self)
+
+
+class FakeMessage:
+    def __init__(self, chat_id, message_id=0, user_id=None, text=""):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+        self.from_user = SimpleNamespace(id=user_id)
+        self.text = FakeText(text)
+        self.caption = None
+        self.media = None
+        self.command = text.lstrip("/").split() if text.startswith("/") else []
+        self.media_group_id = None
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage(self.chat.id, message_id=random.randint(1, 10**9))
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+
+# ---------- In-memory outbox ----------
+class MemoryOutbox:
+    # stands in for the outbox collection with the few queries main.py sends it. mongomock
+    # answers a claim with a scan and a deep copy of every job, which made the bench measure
+    # mongomock; here due jobs sit in one heap per priority, ordered by run_at, so a claim
+    # costs about as much as the index does on a real server.
+    name = "outbox"
+
+    def __init__(self):
+        self.jobs = {}  # _id -> job
+        self.heaps = {}  # priority -> [(run_at, seq, _id)], stale entries skipped on pop
+        self.version = {}  # _id -> seq of its live heap entry
+        self.seq = itertools.count()
+
+    def _push(self, job):
+        seq = next(self.seq)
+        self.version[job["_id"]] = seq
+        heapq.heappush(self.heaps.setdefault(job["priority"], []), (job["run_at"], seq, job["_id"]))
+
+    @staticmethod
+    def _update(job, update):
+        job.update(update.get("$set", {}))
+        for field, value in update.get("$inc", {}).items():
+            job[field] = job.get(field, 0) + value
+
+    @staticmethod
+    def _matches(job, query):
+        return all(job.get(k) == v for k, v in query.items())
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def insert_many(self, jobs, ordered=True):
+        for job in jobs:
+            job.setdefault("_id", ObjectId())
+            self.jobs[job["_id"]] = dict(job)
+            self._push(self.jobs[job["_id"]])
+
+    async def find_one_and_update(self, query, update, sort=None, return_document=None):
+        # the claim in claim_job: due, in an owned partition, lowest priority then oldest run_at
+        now = query["run_at"]["$lte"]
+        partitions = set(query["partition"]["$in"])
+        priorities = [query["priority"]] if "priority" in query else sorted(self.heaps)
+        for priority in priorities:
+            heap = self.heaps.get(priority, [])
+            skipped = []
+            claimed = None
+            while heap and heap[0][0] <= now:
+                _, seq, _id = heapq.heappop(heap)
+                if self.version.get(_id) != seq:
+                    continue
+                if self.jobs[_id].get("partition") not in partitions:
+                    skipped.append((self.jobs[_id]["run_at"], seq, _id))
+                    continue
+                claimed = self.jobs[_id]
+                break
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            if claimed:
+                self._update(claimed, update)
+                self._push(claimed)
+                return dict(claimed)
+        return None
+
+    async def update_one(self, query, update):
+        job = self.jobs.get(query["_id"])
+        if job:
+            self._update(job, update)
+            self._push(job)
+
+    async def update_many(self, query, update):
+        for job in [j for j in self.jobs.values() if self._matches(j, query)]:
+            self._update(job, update)
+            self._push(job)
+
+    async def delete_one(self, query):
+        if self.jobs.pop(query["_id"], None) is not None:
+            del self.version[query["_id"]]
+
+    async def count_documents(self, query):
+        if not query:
+            return len(self.jobs)
+        return sum(1 for job in self.jobs.values() if self._matches(job, query))
+
+    async def find_one(self, query=None):
+        return next((dict(j) for j in self.jobs.values() if self._matches(j, query or {})), None)
+
+
+# ---------- Harness ----------
+def reset_bot(args):
+    # fresh stand-in database and empty in-memory state for every run, so no sweep point
+    # inherits queues, breakers, caches or metrics from the one before
+    fake_db = AsyncMongoMockClient()["autoforward_db"]
+    bot.db = fake_db
+    for name, value in list(vars(bot).items()):
+        if name.endswith("_collection"):
+            setattr(bot, name, fake_db[value.name])
+    bot.outbox_collection = MemoryOutbox()
+    for state in (bot.user_routes, bot.routing_index, bot.compiled_rules, bot.dead_chats, bot.fanouts,
+                  bot.chat_buckets, bot.breakers, bot.failure_digest, bot.deferred_jobs, bot.hot_map,
+                  bot.map_writes, bot.pending_albums, bot.pending_bursts, bot.active_backfills):
+        state.clear()
+    for outcome in bot.forward_counts:
+        bot.forward_counts[outcome] = 0
+    with bot.metrics.lock:
+        bot.metrics.counters.clear()
+        bot.metrics.gauges.clear()
+        bot.metrics.histograms.clear()
+        bot.metrics.collected = {}
+    bot.user_cache = bot.AsyncTTLCache(bot.USER_CACHE_SIZE, bot.USER_CACHE_TTL)
+    bot.chat_cache = bot.AsyncTTLCache(bot.CHAT_CACHE_SIZE, bot.CHAT_CACHE_TTL)
+    bot.member_cache = bot.AsyncTTLCache(bot.FSUB_CACHE_SIZE, bot.FSUB_CACHE_TTL)
+    bot.lane_slots = {lane: asyncio.Semaphore(slots) for lane, slots in bot.LANE_SLOTS.items()}
+    for event in (bot.stopping, bot.outbox_closing, bot.outbox_wakeup):
+        event.clear()
+    bot.owned_partitions.update(range(bot.PARTITIONS))  # a single process owns every partition
+    # keep retries short so injected errors do not stall a run for minutes
+    bot.OUTBOX_BACKOFF = [0.1, 0.2, 0.4, 0.8]
+    bot.BURST_WINDOW = args.burst_window
+    if args.telegram_limits:
+        bot.global_bucket = bot.TokenBucket(bot.GLOBAL_RATE, bot.GLOBAL_RATE)
+    else:
+        bot.global_bucket = bot.TokenBucket(1e9, 1e9)
+        bot.CHAT_RATE_PER_MIN = 1e9
+        bot.PRIVATE_RATE = 1e9
+    gc.collect()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def seed_users(users, dests, sources, shared=False, rules=0):
+    # shared: every user forwards into the same destinations (e.g. one admin team)
+    # rules: include keywords per destination; each user matches roughly one post in ten
+    docs = []
+    for u in range(users):
+        dest_ids = [DEST_BASE - ((0 if shared else u) * dests + d) for d in range(dests)]
+        doc = {"_id": 100000 + u, "source_chat": SOURCE_BASE - (u % sources), "destination_chats": dest_ids}
+        if rules:
+            keywords = [f"topic{u % 10}"] + [f"word{u}x{k}" for k in range(rules - 1)]
+            doc["rules"] = {str(d): {"include": keywords, "exclude": ["spam"]} for d in dest_ids}
+        docs.append(doc)
+    if docs:
+        await bot.users_collection.insert_many(docs)
+
+
+async def bench_forward(args, users, dests, rate):
+    reset_bot(args)
+    client = FakeClient(args.latency, args.flood_rate, args.flood_seconds, args.error_rate)
+    await seed_users(users, dests, args.sources, args.shared_dests, args.rules)
+    await bot.load_routing_index()
+    workers = await bot.start_outbox(client)
+
+    tracemalloc.reset_peak()
+    posted = {}
+    started = time.monotonic()
+    for i in range(args.posts):
+        source = SOURCE_BASE - (i % args.sources)
+        message = FakeMessage(source, message_id=i + 1, text=f"post {i} about topic{i % 10}")
+        posted[(source, message.id)] = time.monotonic()
+        await bot.forward_message(client, message)
+        await asyncio.sleep(1 / rate)
+    while bot.burst_tasks or bot.pending_albums or await bot.outbox_collection.count_documents({}):
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    # posts every rule filtered out never arrive and are left out
+    latencies = [client.last_delivery[key] - t for key, t in posted.items() if key in client.last_delivery]
+    copies = client.delivered.total()
+    return {
+        "posts/s": args.posts / elapsed,
+        "copies/s": copies / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_mb": peak / 2**20,
+        "calls": dict(client.calls),
+    }
+
+
+async def bench_broadcast(args, users):
+    reset_bot(args)
+    client = FakeClient(args.latency, args.flood_rate, args.flood_seconds, args.error_rate)
+    await seed_users(users, 0, 1)
+
+    tracemalloc.reset_peak()
+    started = time.monotonic()
+    await bot.broadcast_cmd(client, FakeMessage(bot.OWNER_ID, user_id=bot.OWNER_ID, text="/broadcast bench"))
+    await asyncio.gather(*bot.broadcast_tasks)
+    elapsed = time.monotonic() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    return {
+        "users/s": users / elapsed,
+        "seconds": elapsed,
+        "peak_mb": peak / 2**20,
+        "calls": dict(client.calls),
+    }
+
+
+async def bench_menu(args, dests):
+    reset_bot(args)
+    client = FakeClient(args.latency, seed=2)
+    await seed_users(1, dests, 1)
+    message = FakeMessage(100000, user_id=100000)
+
+    tracemalloc.reset_peak()
+    timings = []
+    for _ in range(args.menu_repeats):
+        started = time.monotonic()
+        await bot.show_destiny_list(client, message)
+        timings.append(time.monotonic() - started)
+    return {
+        "cold": timings[0],
+        "warm_p50": percentile(timings[1:], 50),
+        "peak_mb": tracemalloc.get_traced_memory()[1] / 2**20,
+        "calls": dict(client.calls),
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",") if v]
+
+
+def fmt(result):
+    return "  ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items())
+
+
+async def run(args):
+    tracemalloc.start()
+    if args.scenario in ("forward", "all"):
+        for users, dests, rate in itertools.product(args.users, args.dests, args.rate):
+            result = await bench_forward(args, users, dests, rate)
+            print(f"forward   users={users:<5} dests={dests:<3} rate={rate:<6g} {fmt(result)}")
+    if args.scenario in ("broadcast", "all"):
+        for users in args.users:
+            result = await bench_broadcast(args, users)
+            print(f"broadcast users={users:<5} {fmt(result)}")
+    if args.scenario in ("menu", "all"):
+        for dests in args.dests:
+            result = await bench_menu(args, dests)
+            print(f"menu      dests={dests:<3} {fmt(result)}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=["forward", "broadcast", "menu", "all"], default="all")
+    parser.add_argument("--users", type=int_list, default=[1, 10], help="comma separated sweep")
+    parser.add_argument("--dests", type=int_list, default=[1, 3], help="destinations per user, comma separated sweep")
+    parser.add_argument("--rate", type=float_list, default=[50], help="posts per second, comma separated sweep")
+    parser.add_argument("--posts", type=int, default=10, help="posts per forward run")
+    parser.add_argument("--sources", type=int, default=1, help="source channels the users are spread over")
+    parser.add_argument("--shared-dests", action="store_true", help="all users use the same destinations")
+    parser.add_argument("--rules", type=int, default=0, help="include keywords per destination (0: no rules)")
+    parser.add_argument("--burst-window", type=float, default=0, help="BURST_WINDOW for the forward runs")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean fake RPC latency in seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of RPCs answered with FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="FloodWait length")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of RPCs failing with a 500")
+    parser.add_argument("--menu-repeats", type=int, default=5)
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the real 30/s and per-chat limits")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,15 +1,30 @@
 import os
 import re
+import time
+import socket
 import threading
 import asyncio
 import logging
-from flask import Flask
-from pyrogram import Client, filters
+import math
+import heapq
+import itertools
+import random
+import contextlib
+import contextvars
+import html
+import functools
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, jsonify
+from pyrogram import Client, filters, idle, raw, utils
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from motor.motor_asyncio import AsyncIOMotorClient
-from pyrogram.enums import ParseMode
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import OperationFailure
+from pyrogram.enums import ParseMode, ChatMemberStatus, MessageMediaType
 #from pyrogram.errors import UserNotParticipant, ChatAdminRequired, PeerIdInvalid, RPCError, FloodWait, BotBlocked, UserIsBot
-from pyrogram.errors import UserNotParticipant, ChatAdminRequired, PeerIdInvalid, RPCError, FloodWait, UserIsBot
+from pyrogram.errors import UserNotParticipant, ChatAdminRequired, PeerIdInvalid, RPCError, FloodWait, UserIsBot, UserIsBlocked, InputUserDeactivated, BadRequest, Forbidden, NotAcceptable
+from pyrogram.errors import ChannelInvalid, ChatIdInvalid, ChatInvalid, ChatRestricted, UserBannedInChannel, PeerIdNotSupported
 from os import environ
 
 id_pattern = re.compile(r'^.\d+$')
@@ -17,6 +32,274 @@ id_pattern = re.compile(r'^.\d+$')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ---------- Metrics ----------
+# Written from the bot's event loop and read from the Flask thread, so every access takes the lock.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+STARTED_AT = time.time()
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self.collectors = []  # callables returning [(name, labels dict, value)] gauges, run by collect()
+        self.collected = {}  # their gauges as of the last collect()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(LATENCY_BUCKETS)] += 1
+            hist[-1] += value
+
+    def collect(self):
+        # collectors read state the event loop mutates, so only the loop may call this
+        values = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    values[self._key(name, labels)] = value
+            except Exception:
+                logger.exception("Metrics collector failed")
+        with self.lock:
+            self.collected = values
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        # Prometheus text exposition format
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = {**self.gauges, **self.collected}
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        lines = []
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({n for n, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in series.items():
+                    if n == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+        for name in sorted({n for n, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), hist in histograms.items():
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, hist):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                cumulative += hist[len(LATENCY_BUCKETS)]
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = {**self.gauges, **self.collected}
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        flat = lambda key: key[0] + self._labels(key[1])
+        result = {
+            "uptime_seconds": round(time.time() - STARTED_AT),
+            "counters": {flat(k): v for k, v in counters.items()},
+            "gauges": {flat(k): v for k, v in gauges.items()},
+            "histograms": {},
+        }
+        for k, hist in histograms.items():
+            count = sum(hist[:-1])
+            result["histograms"][flat(k)] = {"count": count, "sum": round(hist[-1], 3), "avg": round(hist[-1] / count, 4) if count else 0}
+        return result
+
+metrics = Metrics()
+
+class MongoLatencyListener(monitoring.CommandListener):
+    # pymongo calls these from its own threads
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+        metrics.inc("mongo_command_errors_total", command=event.command_name)
+
+# ---------- Tracing ----------
+# A sampled handler run (or outbox job) gets a Trace in a context variable; every Telegram API call
+# (TracedClient.invoke), Mongo call (TracedCollection), rate-limit wait and FloodWait sleep made
+# while it runs, including in tasks it starts, adds a span. Runs slower than SLOW_HANDLER_SECONDS
+# are logged with their spans summed per kind and name, and loop_lag_monitor reports how late the
+# event loop wakes up, which is time some callback spent blocking it.
+TRACE_SAMPLE = float(environ.get("TRACE_SAMPLE", 1))  # share of runs whose spans are recorded
+SLOW_HANDLER_SECONDS = float(environ.get("SLOW_HANDLER_SECONDS", 2))
+LOOP_LAG_INTERVAL = 1  # seconds between loop lag probes
+METRICS_COLLECT_INTERVAL = 5  # seconds between collector gauge snapshots
+LOOP_LAG_WARN = float(environ.get("LOOP_LAG_WARN", 0.5))  # seconds
+current_trace = contextvars.ContextVar("current_trace", default=None)
+active_traces = set()
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.spans = []  # (kind, name, seconds)
+        self.open = True  # tasks started by the run may outlive it; they stop adding spans
+
+    def breakdown(self, top=6):
+        totals = {}
+        for kind, name, seconds in self.spans:
+            total = totals.setdefault((kind, name), [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        ranked = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
+        return ", ".join(f"{kind} {name} {seconds:.2f}s×{count}" for (kind, name), (seconds, count) in ranked[:top]) or "no spans"
+
+@contextlib.contextmanager
+def span(kind, name):
+    current = current_trace.get()
+    if current is None or not current.open:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - start
+        current.spans.append((kind, name, seconds))
+        metrics.observe("span_seconds", seconds, kind=kind, call=name)
+
+@contextlib.contextmanager
+def trace(name):
+    current = Trace(name) if random.random() < TRACE_SAMPLE else None
+    token = current_trace.set(current)
+    if current:
+        active_traces.add(current)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+        if current:
+            current.open = False
+            active_traces.discard(current)
+        elapsed = time.monotonic() - start
+        if elapsed > SLOW_HANDLER_SECONDS:
+            metrics.inc("slow_handlers_total", handler=name)
+            logger.warning(f"Slow {name}: {elapsed:.2f}s ({current.breakdown() if current else 'not sampled'})")
+
+class TracedCollection:
+    # a motor collection whose awaited calls are db spans; cursors (find, aggregate, watch) pass through
+    TRACED = {"find_one", "find_one_and_update", "insert_one", "insert_many", "update_one", "update_many",
+              "replace_one", "delete_one", "delete_many", "count_documents", "distinct", "bulk_write"}
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, attr):
+        value = getattr(self.collection, attr)
+        if attr not in self.TRACED:
+            return value
+        async def call(*args, **kwargs):
+            with span("db", f"{self.collection.name}.{attr}"):
+                return await value(*args, **kwargs)
+        return call
+
+async def loop_lag_monitor():
+    # a sleep that wakes up late means something held the loop for the difference
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = time.monotonic() - start - LOOP_LAG_INTERVAL
+        metrics.observe("event_loop_lag_seconds", lag)
+        if lag > LOOP_LAG_WARN:
+            running = ", ".join(sorted(t.name for t in active_traces)) or "none"
+            logger.warning(f"Event loop lagged {lag:.2f}s; traced runs in progress: {running}")
+
+async def metrics_collector():
+    # the Flask thread serves the last snapshot instead of walking live dicts itself
+    while True:
+        metrics.collect()
+        await asyncio.sleep(METRICS_COLLECT_INTERVAL)
+
+# counts in-flight calls and duration of a Pyrogram handler, traces it and sets its lane
+def instrumented(name, lane="interactive"):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, update, *args, **kwargs):
+            metrics.add("handlers_in_flight", 1, handler=name)
+            start = time.monotonic()
+            # handlers run in Pyrogram's worker tasks, so the lane is put back afterwards
+            lane_token = current_lane.set(lane)
+            try:
+                with trace(name):
+                    return await func(client, update, *args, **kwargs)
+            except Exception:
+                metrics.inc("handler_errors_total", handler=name)
+                raise
+            finally:
+                current_lane.reset(lane_token)
+                metrics.add("handlers_in_flight", -1, handler=name)
+                metrics.observe("handler_seconds", time.monotonic() - start, handler=name)
+        return wrapper
+    return decorator
+
+# ---------- Lifecycle ----------
+# main() warms up first (Mongo, indexes, routing index, bot identity) and only then reports ready.
+# On SIGTERM it stops taking updates, lets handlers and in-flight sends finish, flushes open album
+# and burst windows and releases what is left, all within SHUTDOWN_TIMEOUT (Heroku kills after 30s).
+SHUTDOWN_TIMEOUT = float(environ.get("SHUTDOWN_TIMEOUT", 25))  # seconds
+bot_ready = threading.Event()  # read by the health server thread
+stopping = asyncio.Event()
+
+async def pause(seconds, event=None, wake_on_stop=True):
+    # sleeps for up to seconds, returning early when event is set or (unless told not to) shutdown starts
+    waiters = [asyncio.ensure_future(e.wait()) for e in (stopping if wake_on_stop else None, event) if e is not None]
+    try:
+        await asyncio.wait(waiters, timeout=seconds, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+async def drain(tasks, deadline):
+    # waits for tasks until the deadline, then cancels the rest; returns how many were cut off
+    tasks = [t for t in tasks if not t.done()]
+    if tasks:
+        await asyncio.wait(tasks, timeout=max(0, deadline - time.monotonic()))
+    left = [t for t in tasks if not t.done()]
+    for task in left:
+        task.cancel()
+    if left:
+        await asyncio.wait(left)
+    return len(left)
+
 # ---------- Flask healthcheck server ----------
 flask_app = Flask(__name__)
 
@@ -24,11 +307,28 @@ flask_app = Flask(__name__)
 def home():
     return "Bot is running!"
 
+@flask_app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@flask_app.route('/status')
+def status_endpoint():
+    return jsonify(metrics.snapshot())
+
+@flask_app.route('/ready')
+def ready_endpoint():
+    # 503 while warming up and while draining, so traffic only goes to a bot that can serve it
+    if bot_ready.is_set():
+        return "ready"
+    return Response("not ready", status=503, mimetype="text/plain")
+
 def run_flask():
     port = int(os.environ.get("PORT", 8080))
     flask_app.run(host="0.0.0.0", port=port)
 
-threading.Thread(target=run_flask).start()
+def start_health_server():
+    # a daemon thread, so it never holds up the exit
+    threading.Thread(target=run_flask, name="health", daemon=True).start()
 # ---------- end Flask ----------
 
 # ---------- MongoDB Client ----------
@@ -37,83 +337,1301 @@ if not MONGO_DB_URL:
     print("Error: MONGO_DB_URL environment variable is not set. Exiting.")
     exit(1)
 
-db_client = AsyncIOMotorClient(MONGO_DB_URL)
+# connect=False: nothing is opened at import time; the first query (the ping in main) connects
+db_client = AsyncIOMotorClient(MONGO_DB_URL, connect=False, event_listeners=[MongoLatencyListener()])
 db = db_client.autoforward_db
-users_collection = db.users  # Stores user-specific data (sources, destinations)
+users_collection = TracedCollection(db.users)  # Stores user-specific data (sources, destinations)
+outbox_collection = TracedCollection(db.outbox)  # Pending forward jobs, claimed by the outbox workers
+broadcasts_collection = TracedCollection(db.broadcasts)  # Broadcast jobs with their progress checkpoint
+stats_collection = TracedCollection(db.stats)  # Materialized counters read by /stats
+chat_health_collection = TracedCollection(db.chat_health)  # Last access audit result per chat
+partitions_collection = TracedCollection(db.partitions)  # Which forwarding process owns which source partition
+workers_collection = TracedCollection(db.workers)  # Heartbeats of the forwarding processes
+backfills_collection = TracedCollection(db.backfills)  # Progress of /backfill per (source, destination)
+message_map_collection = TracedCollection(db.message_map)  # Source post -> copies in the destinations, expires after MAP_TTL_DAYS
+conversations_collection = TracedCollection(db.conversations)  # Unfinished multi-step commands per user, expire via TTL index
 
 # ---------- Pyrogram client ----------
-app = Client(
-    "autoforward",
+# ROLE=all     receives updates and forwards (single process, the default)
+# ROLE=ingest  receives updates and queues forwards, but sends nothing itself
+# ROLE=worker  only drains the outbox for the source partitions it holds; add more of these to scale
+ROLE = environ.get("ROLE", "all")
+
+# replies made by command and button handlers; they count against the global rate limit ahead
+# of every other lane (the send helpers of the other lanes throttle themselves)
+INTERACTIVE_SENDS = (
+    raw.functions.messages.SendMessage, raw.functions.messages.SendMedia,
+    raw.functions.messages.EditMessage, raw.functions.messages.SetBotCallbackAnswer
+)
+
+class TracedClient(Client):
+    # every API call, high-level methods included, goes through invoke
+    async def invoke(self, query, *args, **kwargs):
+        if current_lane.get() == "interactive" and isinstance(query, INTERACTIVE_SENDS):
+            return await self._invoke_interactive(query, *args, **kwargs)
+        with span("rpc", query.QUALNAME.removeprefix("functions.")):
+            return await super().invoke(query, *args, **kwargs)
+
+    async def _invoke_interactive(self, query, *args, **kwargs):
+        # holds one of the INTERACTIVE_SLOTS for the call only; short FloodWaits, which Pyrogram
+        # would sleep through inside invoke, are slept here with the slot given back
+        kwargs["sleep_threshold"] = 0
+        while True:
+            try:
+                async with lane_slots["interactive"]:
+                    await global_bucket.acquire(LANES["interactive"])
+                    with span("rpc", query.QUALNAME.removeprefix("functions.")):
+                        return await super().invoke(query, *args, **kwargs)
+            except FloodWait as e:
+                wait = record_flood_wait(e)
+                if wait > self.sleep_threshold:
+                    raise
+                await flood_sleep(wait + 1)
+
+app = TracedClient(
+    "autoforward" if ROLE != "worker" else "autoforward-worker",
     api_id=int(os.environ["API_ID"]),
     api_hash=os.environ["API_HASH"],
-    bot_token=os.environ["BOT_TOKEN"]
+    bot_token=os.environ["BOT_TOKEN"],
+    no_updates=ROLE == "worker",
+    in_memory=ROLE == "worker"
 )
 
 AUTH_CHANNEL = [int(ch) if id_pattern.search(ch) else ch for ch in environ.get('AUTH_CHANNEL', '-1002245813234').split()] 
 OWNER_ID = 5926160191  # আপনার Owner আইডি
 
-# In-memory store for states
-waiting_for_destiny = set()
+# ---------- Conversation state ----------
+# Which multi-step command a user is in the middle of (e.g. "destiny" after /set_destiny), with any
+# data the next step needs. Entries expire after STATE_TTL so abandoned flows do not pile up.
+# STATE_STORE=mongo (default) shares the state between bot processes; memory keeps it per process.
+STATE_STORE = environ.get("STATE_STORE", "mongo")
+STATE_TTL = int(environ.get("STATE_TTL", 600))  # seconds
+STATE_SWEEP_INTERVAL = 60  # seconds
+
+class MemoryStateStore:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}  # user_id -> (state, data, expires)
+
+    async def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[2] <= time.monotonic():
+            del self.entries[user_id]
+            return None
+        return {"state": entry[0], "data": entry[1]}
+
+    async def set(self, user_id, state, data=None, ttl=None):
+        self.entries[user_id] = (state, data or {}, time.monotonic() + (ttl or self.ttl))
+
+    async def clear(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def sweep(self):
+        now = time.monotonic()
+        expired = [user_id for user_id, entry in self.entries.items() if entry[2] <= now]
+        for user_id in expired:
+            del self.entries[user_id]
+        return len(expired)
+
+class MongoStateStore:
+    # the TTL index removes expired documents within a minute or so; get() ignores them before that
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    async def get(self, user_id):
+        doc = await conversations_collection.find_one({"_id": user_id, "expires": {"$gt": datetime.now(timezone.utc)}})
+        return {"state": doc["state"], "data": doc.get("data") or {}} if doc else None
+
+    async def set(self, user_id, state, data=None, ttl=None):
+        expires = datetime.now(timezone.utc) + timedelta(seconds=ttl or self.ttl)
+        await conversations_collection.replace_one({"_id": user_id}, {"state": state, "data": data or {}, "expires": expires}, upsert=True)
+
+    async def clear(self, user_id):
+        await conversations_collection.delete_one({"_id": user_id})
+
+    def sweep(self):
+        return 0
+
+state_store = MongoStateStore(STATE_TTL) if STATE_STORE == "mongo" else MemoryStateStore(STATE_TTL)
+
+async def state_sweeper():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        expired = state_store.sweep()
+        if expired:
+            logger.info(f"Dropped {expired} expired conversation state(s)")
+
+# ---------- Caches ----------
+class AsyncTTLCache:
+    # size-bounded LRU whose entries expire after ttl seconds; concurrent lookups of the
+    # same missing key share a single load
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.loading = {}  # key -> task loading it
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+            self.put(key, value)
+            return value
+        finally:
+            self.loading.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            self.loading[key] = task
+        # shield: one caller giving up must not cancel the load the others wait on
+        return await asyncio.shield(task)
 
 # ---------- Helper Functions ----------
+# User documents are read through user_cache and every write returns the previous document,
+# so the cached copy is replaced instead of re-read. Reads never insert; writes upsert.
+USER_CACHE_SIZE = int(environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(environ.get("USER_CACHE_TTL", 300))  # seconds
+USER_FIELDS = {"source_chat": 1, "destination_chats": 1, "rules": 1}
+user_cache = AsyncTTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def _empty_user(user_id):
+    return {"_id": user_id, "source_chat": None, "destination_chats": [], "rules": {}}
+
 async def get_user_data(user_id):
-    user_data = await users_collection.find_one({"_id": user_id})
-    if not user_data:
-        user_data = {"_id": user_id, "source_chat": None, "destination_chats": []}
-        await users_collection.insert_one(user_data)
-    return user_data
+    async def load():
+        return await users_collection.find_one({"_id": user_id}, USER_FIELDS) or _empty_user(user_id)
+    return await user_cache.get_or_load(user_id, load)
+
+async def _write_user(user_id, update):
+    # applies update (upserting) and returns the document as it was before, or None if it is new
+    before = await users_collection.find_one_and_update(
+        {"_id": user_id}, update, projection=USER_FIELDS, upsert=True, return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        await bump_totals(users=1)
+    return before
+
+def _cache_user(user_id, before, **changes):
+    after = dict(before or _empty_user(user_id))
+    after.update(changes)
+    user_cache.put(user_id, after)
 
 async def update_user_data(user_id, field, value):
-    await users_collection.update_one({"_id": user_id}, {"$set": {field: value}}, upsert=True)
+    before = await _write_user(user_id, {"$set": {field: value}})
+    if field == "source_chat":
+        had_source = bool(before and before.get("source_chat") is not None)
+        await bump_totals(sources=(value is not None) - had_source)
+        _route_set_source(user_id, value)
+    if field in USER_FIELDS:
+        _cache_user(user_id, before, **{field: value})
+    else:
+        user_cache.invalidate(user_id)
 
 async def add_destination(user_id, chat_id):
-    await users_collection.update_one({"_id": user_id}, {"$addToSet": {"destination_chats": chat_id}})
+    # returns False if the destination was already there
+    before = await _write_user(user_id, {"$addToSet": {"destination_chats": chat_id}})
+    dests = list((before or {}).get("destination_chats") or [])
+    added = chat_id not in dests
+    if added:
+        dests.append(chat_id)
+        await bump_totals(destinations=1)
+    _cache_user(user_id, before, destination_chats=dests)
+    _route_user(user_id)["dests"].add(chat_id)
+    return added
 
 async def remove_destination(user_id, chat_id):
-    await users_collection.update_one({"_id": user_id}, {"$pull": {"destination_chats": chat_id}})
-
-# safe send with floodwait handling and limited concurrency
-async def send_with_retry(client, chat_id, text, parse_mode="html", semaphore=None, retries=3):
-    # semaphore to limit concurrent sends (avoid floods)
-    if semaphore is None:
-        semaphore = asyncio.Semaphore(10)
-    async with semaphore:
-        for attempt in range(retries):
-            try:
-                return await client.send_message(chat_id, text, parse_mode=parse_mode)
-            except FloodWait as e:
-                wait = e.x if hasattr(e, 'x') else getattr(e, 'value', 5)
-                logger.warning(f"FloodWait: sleeping for {wait} seconds before retrying send to {chat_id}")
-                await asyncio.sleep(wait + 1)
-            except (BotBlocked, UserIsBot) as e:
-                logger.info(f"Cannot send message to {chat_id}: {e}")
-                return None
-            except Exception as e:
-                logger.exception(f"Failed to send message to {chat_id} on attempt {attempt+1}: {e}")
-                await asyncio.sleep(1)
-        return None
+    # the destination's rules go with it
+    before = await _write_user(user_id, {"$pull": {"destination_chats": chat_id}, "$unset": {f"rules.{chat_id}": ""}})
+    dests = list((before or {}).get("destination_chats") or [])
+    if chat_id in dests:
+        dests = [d for d in dests if d != chat_id]
+        await bump_totals(destinations=-1)
+    rules = dict((before or {}).get("rules") or {})
+    rules.pop(str(chat_id), None)
+    _cache_user(user_id, before, destination_chats=dests, rules=rules)
+    _route_user(user_id)["dests"].discard(chat_id)
+    _route_set_rules(user_id, rules)
 
-# safe copy_message with floodwait handling
-async def copy_with_retry(client, chat_id, from_chat_id, message_id, semaphore=None, retries=3):
-    if semaphore is None:
-        semaphore = asyncio.Semaphore(5)
-    async with semaphore:
-        for attempt in range(retries):
-            try:
-                return await client.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, disable_notification=True)
-            except FloodWait as e:
-                wait = e.x if hasattr(e, 'x') else getattr(e, 'value', 5)
-                logger.warning(f"FloodWait: sleeping for {wait} seconds before retrying copy to {chat_id}")
-                await asyncio.sleep(wait + 1)
-            except Exception as e:
-                logger.exception(f"Failed to copy message to {chat_id} on attempt {attempt+1}: {e}")
-                await asyncio.sleep(1)
+async def set_rule(user_id, dest, rule):
+    # replaces every rule of one destination; an empty rule removes them
+    key = f"rules.{dest}"
+    before = await _write_user(user_id, {"$set": {key: rule}} if rule else {"$unset": {key: ""}})
+    rules = dict((before or {}).get("rules") or {})
+    if rule:
+        rules[str(dest)] = rule
+    else:
+        rules.pop(str(dest), None)
+    _cache_user(user_id, before, rules=rules)
+    _route_set_rules(user_id, rules)
+
+# ---------- Indexes & counters ----------
+# /stats reads two small documents from the stats collection instead of scanning users:
+#   {"_id": "totals", users, sources, destinations}  kept up to date by the write helpers
+#   {"_id": "day:YYYY-MM-DD", sent, failed, skipped}  forwards per day, flushed in batches
+STATS_FLUSH_INTERVAL = 10  # seconds
+forward_counts = {"sent": 0, "failed": 0, "skipped": 0}
+
+async def ensure_indexes():
+    await users_collection.create_index("source_chat")
+    await users_collection.create_index("destination_chats")
+    await outbox_collection.create_index([("partition", 1), ("priority", 1), ("run_at", 1)])
+    await backfills_collection.create_index("status")
+    await message_map_collection.create_index("created", expireAfterSeconds=MAP_TTL_DAYS * 86400)
+    await conversations_collection.create_index("expires", expireAfterSeconds=0)
+    await broadcasts_collection.create_index("status")
+
+async def bump_totals(**deltas):
+    deltas = {k: v for k, v in deltas.items() if v}
+    if deltas:
+        await stats_collection.update_one({"_id": "totals"}, {"$inc": deltas}, upsert=True)
+
+async def count_totals():
+    # full scan; only used to seed or rebuild the counters
+    total_users = await users_collection.count_documents({})
+    total_sources = await users_collection.count_documents({"source_chat": {"$ne": None}})
+    pipeline = [{"$unwind": "$destination_chats"},
+                {"$group": {"_id": None, "total": {"$sum": 1}}}]
+    dest_agg = await users_collection.aggregate(pipeline).to_list(None)
+    total_destinations = dest_agg[0]["total"] if dest_agg else 0
+    return {"users": total_users, "sources": total_sources, "destinations": total_destinations}
+
+async def seed_totals(rebuild=False):
+    if not rebuild and await stats_collection.find_one({"_id": "totals"}, {"_id": 1}):
+        return
+    totals = await count_totals()
+    await stats_collection.update_one({"_id": "totals"}, {"$set": totals}, upsert=True)
+    logger.info(f"Stats counters seeded: {totals}")
+
+def day_key(when=None):
+    return "day:" + (when or datetime.now(timezone.utc)).strftime("%Y-%m-%d")
+
+def count_forward(outcome):
+    forward_counts[outcome] += 1
+
+async def flush_forward_counts():
+    deltas = {k: v for k, v in forward_counts.items() if v}
+    if not deltas:
+        return
+    for k in deltas:
+        forward_counts[k] -= deltas[k]
+    await stats_collection.update_one({"_id": day_key()}, {"$inc": deltas}, upsert=True)
+
+async def stats_flusher():
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            await flush_forward_counts()
+        except Exception:
+            logger.exception("Could not flush forward counters")
+
+# ---------- Routing index ----------
+# Resident copy of who forwards what, so forward_message never has to query Mongo:
+#   user_routes:   user_id -> {"source": chat_id or None, "dests": set of chat_ids, "rules": {dest: rule}}
+#   routing_index: source chat_id -> set of user_ids subscribed to it
+user_routes = {}
+routing_index = {}
+
+def _route_user(user_id):
+    return user_routes.setdefault(user_id, {"source": None, "dests": set(), "rules": {}})
+
+def _route_set_source(user_id, source):
+    entry = _route_user(user_id)
+    old = entry["source"]
+    compiled_rules.pop(old, None)
+    compiled_rules.pop(source, None)
+    if old is not None and old != source:
+        subscribers = routing_index.get(old)
+        if subscribers is not None:
+            subscribers.discard(user_id)
+            if not subscribers:
+                del routing_index[old]
+    entry["source"] = source
+    if source is not None:
+        routing_index.setdefault(source, set()).add(user_id)
+
+def _route_load_user(user_data):
+    user_id = user_data["_id"]
+    _route_set_source(user_id, user_data.get("source_chat"))
+    user_routes[user_id]["dests"] = set(user_data.get("destination_chats") or [])
+    _route_set_rules(user_id, user_data.get("rules"))
+
+def _route_set_rules(user_id, rules):
+    # Mongo keeps destination ids as string keys
+    entry = _route_user(user_id)
+    entry["rules"] = {int(dest): rule for dest, rule in (rules or {}).items()}
+    compiled_rules.pop(entry["source"], None)
+
+def _route_drop_user(user_id):
+    if user_id in user_routes:
+        _route_set_source(user_id, None)
+        del user_routes[user_id]
+
+def get_routes(source_chat):
+    # (user_id, destination) pairs for every subscriber of a source
+    routes = []
+    for user_id in routing_index.get(source_chat, ()):
+        for dest_chat_id in user_routes[user_id]["dests"]:
+            routes.append((user_id, dest_chat_id))
+    return routes
+
+async def load_routing_index():
+    user_routes.clear()
+    routing_index.clear()
+    compiled_rules.clear()
+    async for user_data in users_collection.find({}, USER_FIELDS):
+        _route_load_user(user_data)
+    logger.info(f"Routing index loaded: {len(user_routes)} users, {len(routing_index)} sources")
+
+CHANGE_STREAM_BACKOFF_MAX = 60  # seconds between attempts to reopen the change stream
+
+async def watch_routing_changes():
+    # picks up writes made outside this process; change streams need a replica set (Atlas has one).
+    # A dropped stream resumes after the last change it saw. When it cannot, the writes in between
+    # are unknown, so the index is loaded again once the new stream is open.
+    resume_token = None
+    reload = False
+    backoff = 1
+    while True:
+        try:
+            async with users_collection.watch(full_document="updateLookup", resume_after=resume_token) as stream:
+                resume_token = stream.resume_token
+                if reload:
+                    await load_routing_index()
+                    reload = False
+                backoff = 1
+                async for change in stream:
+                    user_id = change["documentKey"]["_id"]
+                    doc = change.get("fullDocument")
+                    if change["operationType"] == "delete":
+                        user_cache.invalidate(user_id)
+                        _route_drop_user(user_id)
+                    elif doc:
+                        # also the echo of our own writes; storing it keeps the write-through entry warm
+                        user_cache.put(user_id, {"_id": user_id, **{f: doc[f] for f in USER_FIELDS if f in doc}})
+                        _route_load_user(doc)
+                    else:  # deleted again before the lookup
+                        user_cache.invalidate(user_id)
+                    resume_token = stream.resume_token
+        except OperationFailure as e:
+            if e.code == 40573:  # not a replica set
+                logger.info(f"Change streams unavailable, routing index only tracks local writes: {e}")
+                return
+            logger.warning(f"Routing change stream cannot resume, reloading the index: {e}")
+            resume_token = None
+            reload = True
+        except Exception as e:
+            logger.warning(f"Routing change stream dropped, reopening in {backoff}s: {e}")
+            reload = reload or resume_token is None
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, CHANGE_STREAM_BACKOFF_MAX)
+
+# ---------- Rules ----------
+# Optional per-destination rules, stored next to destination_chats as rules.<dest>:
+#   {"include": [...], "exclude": [...], "media": [...], "strip_links": bool, "replace": [[old, new], ...]}
+# Keywords match case-insensitively anywhere in the text or caption. The rules of every subscriber
+# of a source are compiled into one RuleSet, cached in compiled_rules until a route or rule of that
+# source changes, so each post is scanned once however many subscribers and keywords there are.
+RULE_MEDIA = ["text", "photo", "video", "animation", "document", "audio", "voice", "video_note", "sticker", "poll"]
+LINK_TAG = re.compile(r'<a href="[^"]*">(.*?)</a>', re.S)
+BARE_LINK = re.compile(r"(?:https?://|www\.|\b(?:t|telegram)\.me/)[^\s<]+", re.I)
+compiled_rules = {}  # source chat_id -> RuleSet, or None when no subscriber has rules
+
+Rule = namedtuple("Rule", "include exclude media transform")
+
+def _media_kind(message):
+    if message.media and message.media != MessageMediaType.WEB_PAGE:
+        return message.media.value
+    return "text"
+
+class Transform:
+    # rewrites the HTML of a text or caption; replacements never touch the markup itself
+    def __init__(self, strip_links, replace):
+        self.strip_links = strip_links
+        self.replacements = {html.escape(old, quote=False).lower(): html.escape(new, quote=False) for old, new in replace}
+        olds = sorted(self.replacements, key=len, reverse=True)
+        self.pattern = re.compile(r"(<[^>]*>)|(" + "|".join(map(re.escape, olds)) + ")", re.I) if olds else None
+
+    def __call__(self, text):
+        if self.strip_links:
+            text = BARE_LINK.sub("", LINK_TAG.sub(r"\1", text))
+        if self.pattern:
+            text = self.pattern.sub(lambda m: m.group(1) or self.replacements.get(m.group(2).lower(), m.group(2)), text)
+        return text.strip()
+
+def _rewrite(transform, messages, album):
+    # the override a job carries, or None if the post comes out unchanged
+    if album:
+        captions = [transform(m.caption.html) if m.caption else None for m in messages]
+        if any(c is not None and c != m.caption.html for c, m in zip(captions, messages)):
+            return ("captions", tuple(captions))
         return None
+    message = messages[0]
+    field, original = ("text", message.text) if message.text else ("caption", message.caption)
+    if not original:
+        return None
+    text = transform(original.html)
+    return (field, text) if text != original.html else None
+
+class RuleSet:
+    def __init__(self, rules):
+        # rules: {(user_id, dest): rule document}
+        self.rules = {}
+        transforms = {}
+        keywords = set()
+        for key, doc in rules.items():
+            include = frozenset(k.lower() for k in doc.get("include") or [])
+            exclude = frozenset(k.lower() for k in doc.get("exclude") or [])
+            spec = (bool(doc.get("strip_links")), tuple(map(tuple, doc.get("replace") or [])))
+            transform = None
+            if spec[0] or spec[1]:
+                # subscribers with the same rewrite share it, so a post is rewritten once per variant
+                if spec not in transforms:
+                    transforms[spec] = Transform(*spec)
+                transform = transforms[spec]
+            self.rules[key] = Rule(include, exclude, frozenset(doc.get("media") or []), transform)
+            keywords |= include | exclude
+        # the lookahead tries every position, so keywords overlapping a longer one are found too;
+        # a keyword that is a prefix of the longest match at a position is recovered from prefixes
+        ordered = sorted(keywords, key=len, reverse=True)
+        self.pattern = re.compile("(?=(" + "|".join(map(re.escape, ordered)) + "))", re.I) if ordered else None
+        self.prefixes = {k: [p for p in keywords if k.startswith(p)] for k in keywords}
+
+    def keywords_in(self, text):
+        found = set()
+        if self.pattern and text:
+            for m in self.pattern.finditer(text):
+                found.update(self.prefixes.get(m.group(1).lower(), ()))
+        return found
+
+    def apply(self, messages, routes, album=False, filters=True):
+        # (user_id, dest) routes -> (user_id, dest, override) for the ones the post passes;
+        # filters=False only rewrites, for posts that were already judged
+        found = self.keywords_in("\n".join(m.text or m.caption or "" for m in messages))
+        kinds = {_media_kind(m) for m in messages}
+        rewritten = {}
+        passed = []
+        for user_id, dest in routes:
+            rule = self.rules.get((user_id, dest))
+            if rule is None:
+                passed.append((user_id, dest, None))
+                continue
+            if filters and ((rule.media and not kinds & rule.media) or (rule.include and not rule.include & found) or rule.exclude & found):
+                continue
+            override = None
+            if rule.transform:
+                if rule.transform not in rewritten:
+                    rewritten[rule.transform] = _rewrite(rule.transform, messages, album)
+                override = rewritten[rule.transform]
+                if override and override[0] == "text" and not override[1]:
+                    continue  # nothing left to send
+            passed.append((user_id, dest, override))
+        return passed
+
+def get_ruleset(source_chat):
+    if source_chat not in compiled_rules:
+        rules = {
+            (user_id, dest): rule
+            for user_id in routing_index.get(source_chat, ())
+            for dest, rule in user_routes[user_id]["rules"].items()
+        }
+        compiled_rules[source_chat] = RuleSet(rules) if rules else None
+    return compiled_rules[source_chat]
+
+# ---------- Chat metadata cache ----------
+CHAT_CACHE_SIZE = int(environ.get("CHAT_CACHE_SIZE", 5000))
+CHAT_CACHE_TTL = int(environ.get("CHAT_CACHE_TTL", 600))  # seconds
+
+ChatInfo = namedtuple("ChatInfo", "id title type invite_link")
+chat_cache = AsyncTTLCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+
+async def get_chat_cached(client, chat_id):
+    async def load():
+        chat = await client.get_chat(chat_id)
+        return ChatInfo(chat.id, chat.title, chat.type, getattr(chat, "invite_link", None))
+    return await chat_cache.get_or_load(chat_id, load)
+
+# ---------- Rate limiting ----------
+# Telegram allows a bot roughly 30 messages/s overall, 20 messages/min into one group/channel
+# and about 1 message/s into one private chat. Every outgoing copy/send waits on these buckets;
+# when tokens run short they go to the waiting lane with the highest priority first.
+GLOBAL_RATE = float(environ.get("GLOBAL_RATE", 30))
+CHAT_RATE_PER_MIN = float(environ.get("CHAT_RATE_PER_MIN", 20))
+PRIVATE_RATE = float(environ.get("PRIVATE_RATE", 1))
+MAX_PARALLEL_SENDS = int(environ.get("MAX_PARALLEL_SENDS", 50))
+# share of GLOBAL_RATE a ROLE=ingest process keeps for replies, broadcasts and notices; ROLE=worker
+# processes split the rest. With several ingest processes, divide it between them.
+INGEST_RATE_SHARE = float(environ.get("INGEST_RATE_SHARE", 0.2))
+MAX_CHAT_BUCKETS = 10000
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiters = []  # heap of (priority, arrival, future)
+        self.arrivals = itertools.count()
+        self.timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # seconds until a new waiter would get a token
+        self._refill()
+        return max(0.0, (len(self.waiters) + 1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self, priority=0):
+        # lower priority values are served first, equal ones first come, first served
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.arrivals), future))
+        self._hand_out()
+        await future
+
+    def _hand_out(self):
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():  # skips waiters that were cancelled
+                self.tokens -= 1
+                future.set_result(None)
+        if self.waiters and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later((1 - self.tokens) / self.rate, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self._hand_out()
+
+global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+chat_buckets = {}
+
+def _chat_bucket(chat_id):
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(chat_buckets) >= MAX_CHAT_BUCKETS:
+            # forget chats that have been idle long enough to refill completely
+            for cid in [cid for cid, b in chat_buckets.items() if b.is_full()]:
+                del chat_buckets[cid]
+        if isinstance(chat_id, int) and chat_id > 0:
+            bucket = TokenBucket(PRIVATE_RATE, 1)
+        else:
+            bucket = TokenBucket(CHAT_RATE_PER_MIN / 60, CHAT_RATE_PER_MIN)
+        chat_buckets[chat_id] = bucket
+    return bucket
+
+async def throttle(chat_id, lane=None):
+    priority = LANES[lane or current_lane.get()]
+    with span("wait", "throttle"):
+        await _chat_bucket(chat_id).acquire(priority)
+        await global_bucket.acquire(priority)
+
+def flood_wait_seconds(e):
+    return e.x if hasattr(e, 'x') else getattr(e, 'value', 5)
+
+# seconds to wait for a FloodWait, counted in the metrics
+def record_flood_wait(e):
+    wait = flood_wait_seconds(e)
+    metrics.inc("floodwait_total")
+    metrics.inc("floodwait_seconds_total", wait)
+    return wait
+
+async def flood_sleep(seconds):
+    with span("wait", "floodwait"):
+        await asyncio.sleep(seconds)
+
+# safe send with floodwait handling, limited by the shared send slots and rate buckets
+async def send_with_retry(client, chat_id, text, parse_mode=ParseMode.HTML, retries=3):
+    lane = current_lane.get()
+    for attempt in range(retries):
+        try:
+            async with lane_slots[lane]:
+                await throttle(chat_id, lane)
+                result = await client.send_message(chat_id, text, parse_mode=parse_mode)
+            metrics.inc("telegram_requests_total", method="send_message", outcome="ok")
+            return result
+        except FloodWait as e:
+            wait = record_flood_wait(e)
+            logger.warning(f"FloodWait: sleeping for {wait} seconds before retrying send to {chat_id}")
+            await flood_sleep(wait + 1)
+        except (UserIsBlocked, InputUserDeactivated, UserIsBot) as e:
+            metrics.inc("telegram_requests_total", method="send_message", outcome="error")
+            logger.info(f"Cannot send message to {chat_id}: {e}")
+            return None
+        except Exception as e:
+            metrics.inc("telegram_requests_total", method="send_message", outcome="error")
+            logger.exception(f"Failed to send message to {chat_id} on attempt {attempt+1}: {e}")
+            await asyncio.sleep(1)
+    return None
+
+# runs one outgoing API call with floodwait handling; raises once retries are exhausted so
+# the caller can reschedule, and hands long FloodWaits back instead of sleeping through them
+async def call_with_retry(chat_id, call, retries=3, method="copy_message"):
+    lane = current_lane.get()
+    for attempt in range(retries):
+        try:
+            async with lane_slots[lane]:
+                await throttle(chat_id, lane)
+                result = await call()
+            metrics.inc("telegram_requests_total", method=method, outcome="ok")
+            return result
+        except FloodWait as e:
+            wait = record_flood_wait(e)
+            if wait > FLOODWAIT_INLINE_MAX or attempt == retries - 1:
+                raise
+            logger.warning(f"FloodWait: sleeping for {wait} seconds before retrying copy to {chat_id}")
+            await flood_sleep(wait + 1)
+        except Exception as e:
+            metrics.inc("telegram_requests_total", method=method, outcome="error")
+            # retrying cannot fix a deleted chat or missing rights
+            if attempt == retries - 1 or classify_error(e) in ("permanent", "rejected"):
+                raise
+            logger.warning(f"Failed to copy message to {chat_id} on attempt {attempt+1}: {e}")
+            await asyncio.sleep(1)
+
+# safe copy_message with floodwait handling; caption replaces the original one (HTML)
+async def copy_with_retry(client, chat_id, from_chat_id, message_id, retries=3, caption=None):
+    return await call_with_retry(
+        chat_id,
+        lambda: client.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, caption=caption, parse_mode=ParseMode.HTML, disable_notification=True),
+        retries
+    )
+
+# a rewritten text post is sent anew, copy_message cannot change the text
+async def send_text_with_retry(client, chat_id, text, retries=3):
+    return await call_with_retry(
+        chat_id,
+        lambda: client.send_message(chat_id, text, parse_mode=ParseMode.HTML, disable_notification=True),
+        retries,
+        method="send_message"
+    )
+
+# a whole album in one request; message_id can be any item of the media group.
+# copy_media_group reads the group again first, so this is only left for albums queued without media
+async def copy_album_with_retry(client, chat_id, from_chat_id, message_id, retries=3, captions=None):
+    return await call_with_retry(
+        chat_id,
+        lambda: client.copy_media_group(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, captions=captions, disable_notification=True),
+        retries,
+        method="copy_media_group"
+    )
+
+def album_media(messages):
+    # what SendMultiMedia needs of each item, taken once from the updates the album arrived in
+    media = []
+    for m in messages:
+        item = m.photo or m.video or m.document or m.audio
+        if not item:
+            return None
+        media.append({"file_id": item.file_id, "caption": m.caption.html if m.caption else ""})
+    return media
+
+# sends an album from album_media() in one request; captions (HTML) replace the original ones
+# where not None. Returns the new message ids in album order
+async def send_album_with_retry(client, chat_id, media, retries=3, captions=None):
+    async def send():
+        random_ids = [client.rnd_id() for _ in media]
+        multi_media = []
+        for i, (item, random_id) in enumerate(zip(media, random_ids)):
+            caption = captions[i] if captions and i < len(captions) and captions[i] is not None else item["caption"]
+            multi_media.append(raw.types.InputSingleMedia(
+                media=utils.get_input_media_from_file_id(item["file_id"]),
+                random_id=random_id,
+                **await client.parser.parse(caption, ParseMode.HTML)
+            ))
+        r = await client.invoke(
+            raw.functions.messages.SendMultiMedia(
+                peer=await client.resolve_peer(chat_id),
+                multi_media=multi_media,
+                silent=True
+            )
+        )
+        sent = {u.random_id: u.id for u in getattr(r, "updates", []) if isinstance(u, raw.types.UpdateMessageID)}
+        return [sent[rid] for rid in random_ids if rid in sent]
+    return await call_with_retry(chat_id, send, retries, method="send_multi_media")
+
+FORWARD_BATCH = 100  # message ids Telegram accepts in one forward request
+
+# forwards up to FORWARD_BATCH messages in one request without the "Forwarded from" header,
+# so they look like copies; returns {source message id: new message id}
+async def forward_hidden_with_retry(client, chat_id, from_chat_id, message_ids, retries=3):
+    async def forward():
+        random_ids = [client.rnd_id() for _ in message_ids]
+        r = await client.invoke(
+            raw.functions.messages.ForwardMessages(
+                to_peer=await client.resolve_peer(chat_id),
+                from_peer=await client.resolve_peer(from_chat_id),
+                id=message_ids,
+                random_id=random_ids,
+                silent=True,
+                drop_author=True
+            )
+        )
+        sent = {u.random_id: u.id for u in getattr(r, "updates", []) if isinstance(u, raw.types.UpdateMessageID)}
+        return {mid: sent[rid] for mid, rid in zip(message_ids, random_ids) if rid in sent}
+    return await call_with_retry(chat_id, forward, retries, method="forward_messages")
+
+# ---------- Lanes ----------
+# Outgoing work runs in one of three lanes, served in this order on the shared rate limits:
+#   interactive  replies to commands and buttons
+#   live         forwards of new posts, mirrored edits and deletions
+#   bulk         backfills, broadcasts and notices
+# Each lane has its own budget of parallel sends, so a broadcast cannot take the slots live
+# forwards need, and FloodWait sleeps happen outside the budget. The lane travels in a context
+# variable: instrumented sets it per handler and in_lane for background tasks.
+LANES = {"interactive": 0, "live": 1, "bulk": 2}
+LANE_SLOTS = {
+    "interactive": int(environ.get("INTERACTIVE_SLOTS", 10)),
+    "live": MAX_PARALLEL_SENDS,
+    "bulk": int(environ.get("BULK_SLOTS", 20)),
+}
+lane_slots = {lane: asyncio.Semaphore(slots) for lane, slots in LANE_SLOTS.items()}
+current_lane = contextvars.ContextVar("current_lane", default="bulk")
+lane_tasks = set()  # background work handed off by handlers, drained on shutdown
+
+async def in_lane(lane, coro):
+    # runs coro as a task of that lane; the task's context is its own, so nothing leaks back
+    current_lane.set(lane)
+    return await coro
+
+def spawn(lane, coro):
+    # takes slow work (anything that can hit a FloodWait) off Pyrogram's handler workers
+    task = asyncio.create_task(in_lane(lane, coro))
+    lane_tasks.add(task)
+    task.add_done_callback(lane_tasks.discard)
+    return task
+
+# ---------- Failure handling ----------
+# "floodwait": come back later; "permanent": the destination cannot take posts (403/406 and the
+# 400s about the chat itself, e.g. deleted chat, bot removed or not admin); "rejected": this post
+# can never be sent (any other 400, e.g. caption too long), the destination is fine;
+# "transient": everything else (5xx, timeouts, network, 401s about the bot's own session).
+BREAKER_THRESHOLD = 5  # consecutive transient failures that open a destination's breaker
+BREAKER_COOLDOWN = 300  # seconds before the first probe, doubled after every failed probe
+BREAKER_MAX_COOLDOWN = 6 * 3600
+DIGEST_INTERVAL = int(environ.get("DIGEST_INTERVAL", 900))  # seconds between failure digests
+
+# 401s are about the bot's own session, not the chat, so they are not listed here
+DESTINATION_ERRORS = (
+    Forbidden, NotAcceptable, ChatAdminRequired, PeerIdInvalid, PeerIdNotSupported, ChannelInvalid,
+    ChatIdInvalid, ChatInvalid, ChatRestricted, UserBannedInChannel, UserIsBlocked, UserIsBot, InputUserDeactivated
+)
+
+def classify_error(e):
+    if isinstance(e, FloodWait):
+        return "floodwait"
+    if isinstance(e, DESTINATION_ERRORS):
+        return "permanent"
+    if isinstance(e, BadRequest):
+        return "rejected"
+    return "transient"
+
+class CircuitBreaker:
+    # closed -> open after BREAKER_THRESHOLD failures in a row (or one permanent error);
+    # once the cooldown is over a single probe goes through: success closes the breaker,
+    # failure opens it again for twice as long. Only a breaker opened by a permanent error
+    # drops jobs; one opened by an outage holds them until it may probe again
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = False
+        self.permanent = False
+
+breakers = {}  # dest chat_id -> CircuitBreaker, only for destinations that are failing
+
+def breaker_allows(chat_id):
+    breaker = breakers.get(chat_id)
+    if breaker is None or not breaker.open_until:
+        return True
+    if time.monotonic() < breaker.open_until or breaker.probing:
+        return False
+    breaker.probing = True
+    return True
+
+def breaker_success(chat_id):
+    breakers.pop(chat_id, None)
+
+def breaker_release(chat_id):
+    # the probe ended without telling us anything about the destination; let the next job probe
+    breaker = breakers.get(chat_id)
+    if breaker is not None:
+        breaker.probing = False
+
+def breaker_failure(chat_id, permanent):
+    breaker = breakers.setdefault(chat_id, CircuitBreaker())
+    breaker.failures += 1
+    if permanent or breaker.failures >= BREAKER_THRESHOLD or breaker.probing:
+        if breaker.open_until:
+            breaker.cooldown = min(breaker.cooldown * 2, BREAKER_MAX_COOLDOWN)
+        breaker.open_until = time.monotonic() + breaker.cooldown
+        breaker.permanent = permanent
+        logger.warning(f"Circuit opened for {chat_id} for {breaker.cooldown}s after {breaker.failures} failures")
+    breaker.probing = False
+
+# user_id -> dest chat_id -> [failed posts, last error]; sent as one message per user per interval
+failure_digest = {}
+
+def report_failure(job, error):
+    # jobs queued before destinations were deduplicated carry a single user_id
+    for user_id in job.get("owners") or [job["user_id"]]:
+        entry = failure_digest.setdefault(user_id, {}).setdefault(job["dest"], [0, None])
+        entry[0] += 1
+        entry[1] = error
+
+async def send_failure_digests(client):
+    pending = dict(failure_digest)
+    failure_digest.clear()
+    for user_id, dests in pending.items():
+        text = "⚠️ <b>Some posts could not be forwarded:</b>\n\n"
+        for dest_chat_id, (count, error) in list(dests.items())[:30]:
+            text += f"• <code>{dest_chat_id}</code>: {count} post(s) — {error}\n"
+        if len(dests) > 30:
+            text += f"…and {len(dests) - 30} more destinations\n"
+        text += "\nMake sure the bot is still admin there, or remove the destination with /show_destiny."
+        await send_with_retry(client, user_id, text, parse_mode=ParseMode.HTML)
+
+async def digest_loop(client):
+    while True:
+        await asyncio.sleep(DIGEST_INTERVAL)
+        try:
+            await send_failure_digests(client)
+        except Exception:
+            logger.exception("Could not send failure digests")
+
+# ---------- Outbox ----------
+# Every forward is a document in the outbox collection:
+#   {source, message_id, dest, owners, album, album_ids, album_media, partition, priority, attempts, run_at, owner, queued_at}
+# owners are all users that route this source to dest; each destination gets one copy per post
+# and version of it. Posts rewritten by rules also carry text, caption or captions.
+# Batch jobs carry message_ids instead of message_id and are sent with one hidden forward.
+# Workers always take priority 0 (live posts) before priority 1 (backfill).
+# A job is eligible once run_at has passed. Claiming it pushes run_at forward by the lease,
+# so a job held by a crashed worker becomes eligible again on its own; acking deletes it.
+OUTBOX_WORKERS = int(environ.get("OUTBOX_WORKERS", 20))
+OUTBOX_LEASE = 120  # seconds
+OUTBOX_POLL = 1  # seconds an idle worker waits before looking again
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF = [5, 30, 120, 600]  # seconds before attempt 2, 3, 4, 5
+FLOODWAIT_INLINE_MAX = 10  # longer FloodWaits reschedule the job instead of holding a worker
+THROTTLE_INLINE_MAX = 2  # seconds a worker may wait for a destination's rate limit; longer reschedules
+WORKER_ID = environ.get("DYNO") or f"{socket.gethostname()}-{os.getpid()}"
+
+outbox_wakeup = asyncio.Event()
+outbox_closing = asyncio.Event()  # set on shutdown once nothing new can be queued
+# posts queued by this process that still have destinations left: (source, message_id) -> [left, started]
+fanouts = OrderedDict()
+MAX_TRACKED_FANOUTS = 10000
+
+def plan_fanout(routes):
+    # collapse (user, destination[, override]) routes into (destination, override) -> owning users
+    plan = {}
+    for user_id, dest_chat_id, *override in routes:
+        override = override[0] if override else None
+        plan.setdefault((dest_chat_id, override), []).append(user_id)
+    return plan
+
+async def enqueue_forwards(from_chat_id, message_id, routes, album=None):
+    # album: the messages of a media group, in order; their media is stored so no worker reads it again
+    now = datetime.now(timezone.utc)
+    album_ids = [m.id for m in album] if album else None
+    media = album_media(album) if album else None
+    jobs = [
+        {"source": from_chat_id, "message_id": message_id, "dest": dest_chat_id, "owners": owners,
+         "album": bool(album_ids), "album_ids": album_ids, "album_media": media, "partition": partition_of(from_chat_id), "priority": 0, "attempts": 0, "run_at": now, "owner": None, "queued_at": time.time(),
+         **(dict([override]) if override else {})}
+        for (dest_chat_id, override), owners in plan_fanout(routes).items()
+    ]
+    metrics.inc("fanout_duplicates_skipped_total", len(routes) - len(jobs))
+    fanouts[(from_chat_id, message_id)] = [len(jobs), time.monotonic()]
+    while len(fanouts) > MAX_TRACKED_FANOUTS:
+        fanouts.popitem(last=False)
+    await outbox_collection.insert_many(jobs, ordered=False)
+    outbox_wakeup.set()
+
+async def enqueue_batch(from_chat_id, message_ids, routes, priority=0):
+    # several posts of one source, sent to each destination as hidden forwards of FORWARD_BATCH ids
+    now = datetime.now(timezone.utc)
+    jobs = [
+        {"source": from_chat_id, "message_ids": message_ids[i:i + FORWARD_BATCH], "dest": dest_chat_id, "owners": owners,
+         "partition": partition_of(from_chat_id), "priority": priority, "attempts": 0, "run_at": now, "owner": None, "queued_at": time.time()}
+        for (dest_chat_id, _), owners in plan_fanout(routes).items()
+        for i in range(0, len(message_ids), FORWARD_BATCH)
+    ]
+    if jobs:
+        await outbox_collection.insert_many(jobs, ordered=False)
+        outbox_wakeup.set()
+
+def job_finished(job, outcome):
+    count_forward(outcome)
+    metrics.inc("forwards_total", outcome=outcome)
+    if job.get("queued_at"):
+        metrics.observe("forward_delivery_seconds", time.time() - job["queued_at"])
+    key = (job["source"], job.get("message_id"))
+    fanout = fanouts.get(key)
+    if fanout is not None:
+        fanout[0] -= 1
+        if fanout[0] <= 0:
+            del fanouts[key]
+            metrics.observe("post_fanout_seconds", time.monotonic() - fanout[1])
+
+async def claim_job(live_only=False):
+    now = datetime.now(timezone.utc)
+    query = {"run_at": {"$lte": now}, "partition": {"$in": [*owned_partitions, None]}}  # None: jobs from before partitions
+    if live_only:
+        query["priority"] = 0
+    return await outbox_collection.find_one_and_update(
+        query,
+        {"$set": {"run_at": now + timedelta(seconds=OUTBOX_LEASE), "owner": WORKER_ID}, "$inc": {"attempts": 1}},
+        sort=[("priority", 1), ("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def ack_job(job):
+    await outbox_collection.delete_one({"_id": job["_id"]})
+
+async def retry_job(job, delay, count_attempt=True, deferred=False):
+    update = {"$set": {"run_at": datetime.now(timezone.utc) + timedelta(seconds=delay), "owner": None, "deferred": deferred}}
+    if not count_attempt:
+        update["$inc"] = {"attempts": -1}
+    await outbox_collection.update_one({"_id": job["_id"]}, update)
+
+# dest chat_id -> jobs this process put off because the destination's rate limit was used up;
+# new jobs line up behind them so they come back one token apart instead of all at once
+deferred_jobs = {}
+
+def throttle_delay(job):
+    bucket = _chat_bucket(job["dest"])
+    if job.get("deferred"):
+        # its turn has come; it only waits for the bucket itself
+        left = deferred_jobs.get(job["dest"], 0) - 1
+        if left > 0:
+            deferred_jobs[job["dest"]] = left
+        else:
+            deferred_jobs.pop(job["dest"], None)
+        return bucket.delay()
+    return bucket.delay() + deferred_jobs.get(job["dest"], 0) / bucket.rate
+
+async def process_job(client, job):
+    dest = job["dest"]
+    wait = throttle_delay(job)
+    if wait > THROTTLE_INLINE_MAX:
+        # a busy destination must not hold workers that could serve other destinations
+        deferred_jobs[dest] = deferred_jobs.get(dest, 0) + 1
+        await retry_job(job, wait, count_attempt=False, deferred=True)
+        return
+    if not breaker_allows(dest):
+        breaker = breakers[dest]
+        if not breaker.permanent:
+            # a Telegram or network outage; the post waits it out instead of being lost
+            await retry_job(job, max(breaker.open_until - time.monotonic(), OUTBOX_POLL), count_attempt=False)
+            return
+        # the bot lost access to the destination; drop the post instead of spending requests on it
+        await ack_job(job)
+        job_finished(job, "skipped")
+        report_failure(job, "destination is failing, paused for now")
+        return
+    try:
+        if job.get("message_ids"):
+            copies = await forward_hidden_with_retry(client, dest, job["source"], job["message_ids"])
+        elif job.get("album_media"):
+            sent = await send_album_with_retry(client, dest, job["album_media"], captions=job.get("captions"))
+            copies = dict(zip(job["album_ids"], sent))
+        elif job.get("album"):
+            sent = await copy_album_with_retry(client, dest, job["source"], job["message_id"], captions=job.get("captions"))
+            copies = dict(zip(job.get("album_ids") or [job["message_id"]], (m.id for m in sent)))
+        elif job.get("text") is not None:
+            sent = await send_text_with_retry(client, dest, job["text"])
+            copies = {job["message_id"]: sent.id}
+        else:
+            sent = await copy_with_retry(client, dest, job["source"], job["message_id"], caption=job.get("caption"))
+            copies = {job["message_id"]: sent.id}
+    except Exception as e:
+        kind = classify_error(e)
+        if kind == "floodwait":
+            wait = flood_wait_seconds(e)
+            logger.warning(f"FloodWait of {wait}s on {dest}, rescheduling job {job['_id']}")
+            breaker_release(dest)
+            await retry_job(job, wait + 1, count_attempt=False)
+            return
+        if kind == "rejected":  # e.g. the source post is gone; not the destination's fault
+            breaker_release(dest)
+        else:
+            breaker_failure(dest, permanent=kind == "permanent")
+        if kind == "transient" and job["attempts"] < OUTBOX_MAX_ATTEMPTS:
+            await retry_job(job, OUTBOX_BACKOFF[min(job["attempts"], len(OUTBOX_BACKOFF)) - 1])
+            return
+        logger.warning(f"Giving up on forwarding {job['source']}/{job.get('message_id') or job['message_ids']} to {dest} ({kind}): {e}")
+        await ack_job(job)
+        job_finished(job, "failed")
+        report_failure(job, str(e))
+        return
+    breaker_success(dest)
+    remember_copies(job["source"], dest, copies)
+    await ack_job(job)
+    job_finished(job, "sent")
+
+async def outbox_worker(client):
+    # once the outbox closes, only live posts that are due are sent; the worker ends when none are left
+    while True:
+        try:
+            # bulk jobs wait while their lane is full, so workers stay free for live posts
+            job = await claim_job(live_only=outbox_closing.is_set() or lane_slots["bulk"].locked())
+            if job is None:
+                if outbox_closing.is_set():
+                    return
+                outbox_wakeup.clear()
+                # shutdown wakes idle workers through outbox_wakeup once the outbox closes
+                await pause(OUTBOX_POLL, outbox_wakeup, wake_on_stop=False)
+                continue
+            current_lane.set("live" if not job.get("priority") else "bulk")
+            with trace("outbox_job"):
+                await process_job(client, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Outbox worker error")
+            await pause(OUTBOX_POLL, wake_on_stop=False)
+
+async def release_jobs():
+    # jobs this process still holds can run again right away instead of after the lease
+    await outbox_collection.update_many({"owner": WORKER_ID}, {"$set": {"run_at": datetime.now(timezone.utc), "owner": None}})
+
+async def start_outbox(client):
+    await release_jobs()
+    return [asyncio.create_task(outbox_worker(client)) for _ in range(OUTBOX_WORKERS)]
+
+# ---------- Partitions ----------
+# Sources are split into PARTITIONS buckets by chat id. Each forwarding process holds a lease on
+# a fair share of them (PARTITIONS / live processes) and only claims jobs from those, so adding
+# worker processes spreads the fan-out. Leases of a process that stops heartbeating expire and are
+# picked up by the others. The global rate budget is split the same way, after INGEST_RATE_SHARE
+# is set aside for the ingest processes when they run separately.
+PARTITIONS = int(environ.get("PARTITIONS", 16))
+PARTITION_LEASE = 30  # seconds
+PARTITION_HEARTBEAT = 10  # seconds
+owned_partitions = set()
+
+def partition_of(chat_id):
+    return abs(chat_id) % PARTITIONS
+
+def _apply_rate_share():
+    if ROLE == "ingest":
+        rate = GLOBAL_RATE * INGEST_RATE_SHARE
+    else:
+        pool = GLOBAL_RATE * (1 - INGEST_RATE_SHARE) if ROLE == "worker" else GLOBAL_RATE
+        rate = pool * len(owned_partitions) / PARTITIONS
+    global_bucket.rate = max(rate, 1)
+    global_bucket.capacity = max(rate, 1)
+
+async def balance_partitions():
+    now = datetime.now(timezone.utc)
+    lease_until = now + timedelta(seconds=PARTITION_LEASE)
+    await workers_collection.update_one({"_id": WORKER_ID}, {"$set": {"seen": now}}, upsert=True)
+    live = await workers_collection.count_documents({"seen": {"$gte": now - timedelta(seconds=PARTITION_LEASE)}})
+    fair_share = math.ceil(PARTITIONS / max(live, 1))
+
+    # renew what we hold; a lease that already went to someone else is not touched
+    await partitions_collection.update_many({"owner": WORKER_ID}, {"$set": {"lease_until": lease_until}})
+    owned = {d["_id"] async for d in partitions_collection.find({"owner": WORKER_ID}, {"_id": 1})}
+    for p in sorted(owned)[fair_share:]:
+        await partitions_collection.update_one({"_id": p, "owner": WORKER_ID}, {"$set": {"owner": None, "lease_until": now}})
+        owned.discard(p)
+    while len(owned) < fair_share:
+        doc = await partitions_collection.find_one_and_update(
+            {"$or": [{"owner": None}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "lease_until": lease_until}},
+            projection={"_id": 1}
+        )
+        if doc is None:
+            break
+        owned.add(doc["_id"])
+
+    if owned != owned_partitions:
+        logger.info(f"{WORKER_ID} now owns partitions {sorted(owned)} ({live} live forwarding processes)")
+        owned_partitions.clear()
+        owned_partitions.update(owned)
+        _apply_rate_share()
+
+async def partition_manager():
+    while True:
+        try:
+            await balance_partitions()
+        except Exception:
+            logger.exception("Partition balancing failed")
+        await asyncio.sleep(PARTITION_HEARTBEAT)
+
+async def start_partitions():
+    for p in range(PARTITIONS):
+        await partitions_collection.update_one({"_id": p}, {"$setOnInsert": {"owner": None, "lease_until": None}}, upsert=True)
+    await balance_partitions()
+    return asyncio.create_task(partition_manager())
+
+async def release_partitions():
+    await partitions_collection.update_many({"owner": WORKER_ID}, {"$set": {"owner": None, "lease_until": None}})
+    await workers_collection.delete_one({"_id": WORKER_ID})
+    owned_partitions.clear()
+
+# ---------- Message map ----------
+# Where each forwarded post ended up: (source, source message id) -> [(dest, dest message id)].
+# Recent posts live in a bounded in-memory LRU; every mapping is also written (in batches) to
+# the message_map collection, whose TTL index forgets posts older than MAP_TTL_DAYS.
+MAP_HOT_SIZE = int(environ.get("MAP_HOT_SIZE", 20000))
+MAP_TTL_DAYS = int(environ.get("MAP_TTL_DAYS", 7))
+MAP_FLUSH_INTERVAL = 2  # seconds
+hot_map = OrderedDict()
+map_writes = []
+
+def _map_key(source, message_id):
+    return f"{source}:{message_id}"
+
+def remember_copies(source, dest, copies):
+    # copies: {source message id: dest message id}
+    now = datetime.now(timezone.utc)
+    for src_id, dest_id in copies.items():
+        key = (source, src_id)
+        hot_map.setdefault(key, []).append((dest, dest_id))
+        hot_map.move_to_end(key)
+        map_writes.append(UpdateOne(
+            {"_id": _map_key(source, src_id)},
+            {"$push": {"targets": [dest, dest_id]}, "$setOnInsert": {"created": now}},
+            upsert=True
+        ))
+    while len(hot_map) > MAP_HOT_SIZE:
+        hot_map.popitem(last=False)
+
+async def flush_map_writes():
+    if not map_writes:
+        return
+    ops = map_writes[:]
+    del map_writes[:len(ops)]
+    await message_map_collection.bulk_write(ops, ordered=False)
+
+async def map_flusher():
+    while True:
+        await asyncio.sleep(MAP_FLUSH_INTERVAL)
+        try:
+            await flush_map_writes()
+        except Exception:
+            logger.exception("Could not store message mappings")
+
+async def lookup_copies(source, message_ids):
+    # {source message id: [(dest, dest message id)]}; one query for whatever is not hot
+    found, missing = {}, []
+    for message_id in message_ids:
+        targets = hot_map.get((source, message_id))
+        if targets is not None:
+            found[message_id] = targets
+        else:
+            missing.append(_map_key(source, message_id))
+    if missing:
+        async for doc in message_map_collection.find({"_id": {"$in": missing}}):
+            message_id = int(doc["_id"].rsplit(":", 1)[1])
+            found[message_id] = [tuple(t) for t in doc["targets"]]
+    return found
+
+async def forget_copies(source, message_ids):
+    for message_id in message_ids:
+        hot_map.pop((source, message_id), None)
+    await message_map_collection.delete_many({"_id": {"$in": [_map_key(source, m) for m in message_ids]}})
+
+# ---------- Albums ----------
+# Items of an album arrive as separate updates. The first one opens a short window; when it
+# closes the album is queued once per destination and sent with a single SendMultiMedia.
+ALBUM_WINDOW = float(environ.get("ALBUM_WINDOW", 1.5))  # seconds
+pending_albums = {}  # (chat_id, media_group_id) -> messages seen so far
+album_tasks = set()
+
+async def _flush_album(chat_id, media_group_id):
+    try:
+        await pause(ALBUM_WINDOW)  # cut short on shutdown so the album is queued, not lost
+    finally:
+        messages = sorted(pending_albums.pop((chat_id, media_group_id), []), key=lambda m: m.id)
+    routes = live_routes(chat_id)
+    ruleset = get_ruleset(chat_id)
+    if routes and ruleset:
+        routes = ruleset.apply(messages, routes, album=True)
+    if routes and messages:
+        await enqueue_forwards(chat_id, messages[0].id, routes, album=messages)
+
+def buffer_album_item(message):
+    key = (message.chat.id, message.media_group_id)
+    if key not in pending_albums:
+        pending_albums[key] = []
+        task = asyncio.create_task(_flush_album(message.chat.id, message.media_group_id))
+        album_tasks.add(task)
+        task.add_done_callback(album_tasks.discard)
+    pending_albums[key].append(message)
+
+# ---------- Bursts ----------
+# With BURST_WINDOW > 0, posts from one source are collected for that many seconds after the
+# first one. A lone post or a lone album is queued as usual; anything more goes to each
+# destination as one hidden forward of up to FORWARD_BATCH ids. Off (0) by default.
+BURST_WINDOW = float(environ.get("BURST_WINDOW", 0))  # seconds
+pending_bursts = {}  # source chat_id -> [message]
+burst_tasks = set()
+
+async def _flush_burst(chat_id):
+    try:
+        await pause(BURST_WINDOW)
+    finally:
+        posts = pending_bursts.pop(chat_id, [])
+    routes = live_routes(chat_id)
+    if not routes or not posts:
+        return
+    posts.sort(key=lambda m: m.id)
+    albums = {m.media_group_id for m in posts}
+    if len(albums) == 1 and None not in albums:
+        await enqueue_forwards(chat_id, posts[0].id, routes, album=posts)
+    elif len(posts) == 1:
+        await enqueue_forwards(chat_id, posts[0].id, routes)
+    else:
+        # forwarding album items together keeps them grouped
+        metrics.inc("burst_posts_coalesced_total", len(posts))
+        await enqueue_batch(chat_id, [m.id for m in posts], routes)
+
+def buffer_burst_item(message):
+    posts = pending_bursts.get(message.chat.id)
+    if posts is None:
+        posts = pending_bursts[message.chat.id] = []
+        task = asyncio.create_task(_flush_burst(message.chat.id))
+        burst_tasks.add(task)
+        task.add_done_callback(burst_tasks.discard)
+    posts.append(message)
 
 async def get_subscription_buttons11(bot, user_id, channels):
     btn = []
     for cid in channels:
-        chat = await bot.get_chat(int(cid))
+        chat = await get_chat_cached(bot, int(cid))
         try:
             await bot.get_chat_member(cid, user_id)
         except UserNotParticipant:
@@ -122,27 +1640,66 @@ async def get_subscription_buttons11(bot, user_id, channels):
     return btn  # খালি হলে সব চ্যানেলে আছে
     
 
-async def is_subscribed(bot, query, channel):
+# ---------- Force-subscribe membership cache ----------
+# Only positive answers are cached; a user who has not joined yet is asked again every time.
+# chat_member updates from the auth channels drop the entry as soon as membership changes.
+FSUB_CACHE_TTL = int(environ.get("FSUB_CACHE_TTL", 3600))  # seconds
+FSUB_CACHE_SIZE = int(environ.get("FSUB_CACHE_SIZE", 100000))
+member_cache = AsyncTTLCache(FSUB_CACHE_SIZE, FSUB_CACHE_TTL)
+
+def cache_metrics():
+    values = []
+    for name, cache in (("chat", chat_cache), ("membership", member_cache), ("user", user_cache)):
+        lookups = cache.hits + cache.misses
+        values += [
+            ("cache_hits", {"cache": name}, cache.hits),
+            ("cache_misses", {"cache": name}, cache.misses),
+            ("cache_entries", {"cache": name}, len(cache.entries)),
+            ("cache_hit_ratio", {"cache": name}, round(cache.hits / lookups, 4) if lookups else 0),
+        ]
+    values.append(("routing_sources", {}, len(routing_index)))
+    values.append(("dead_chats", {}, len(dead_chats)))
+    values.append(("open_breakers", {}, sum(1 for b in breakers.values() if b.open_until)))
+    return values
+
+metrics.collectors.append(cache_metrics)
+
+async def is_member(bot, chat_id, user_id):
+    async def check():
+        await bot.get_chat_member(chat_id, user_id)
+        return True
+    return await member_cache.get_or_load((chat_id, user_id), check)
+
+async def is_subscribed(bot, user_id, channel):
     btn = []
     for id in channel:
-        chat = await bot.get_chat(int(id))
+        chat = await get_chat_cached(bot, int(id))
         try:
-            await bot.get_chat_member(id, query.from_user.id)
+            await is_member(bot, chat.id, user_id)
         except UserNotParticipant:
             btn.append([InlineKeyboardButton(f"✇ Join {chat.title} ✇", url=chat.invite_link)]) #✇ ᴊᴏɪɴ ᴏᴜʀ ᴜᴘᴅᴀᴛᴇꜱ ᴄʜᴀɴɴᴇʟ ✇
         except Exception as e:
             pass
     return btn
-            
-        
+
+@app.on_chat_member_updated(filters.chat(AUTH_CHANNEL))
+@instrumented("auth_member_updated")
+async def auth_member_updated(client, update):
+    member = update.new_chat_member or update.old_chat_member
+    if member and member.user:
+        member_cache.invalidate((update.chat.id, member.user.id))
+
 # ---------- START ----------
 @app.on_message(filters.command("start") & filters.private)
+@instrumented("start")
 async def start(client, message):
+    # a user who comes back is reachable again, include them in broadcasts
+    await users_collection.update_one({"_id": message.from_user.id, "blocked": True}, {"$unset": {"blocked": ""}})
     if AUTH_CHANNEL:
         try:
-            btn = await is_subscribed(client, message, AUTH_CHANNEL)
+            btn = await is_subscribed(client, message.from_user.id, AUTH_CHANNEL)
             if btn:
-                username = (await client.get_me()).username
+                username = client.me.username  # fetched once by app.start()
                 if len(message.command) > 1:
                     btn.append([InlineKeyboardButton("♻️ ʀᴇғʀᴇsʜ ♻️", url=f"https://t.me/{username}?start={message.command[1]}")])
                 else:
@@ -186,6 +1743,7 @@ async def start(client, message):
         )
 
 @app.on_callback_query()
+@instrumented("cb_handler")
 async def cb_handler(client, query):
     user_id = query.from_user.id
     if query.data == "close":
@@ -223,7 +1781,7 @@ async def cb_handler(client, query):
         
         
     elif query.data == "about_cmd":
-        me = await client.get_me()
+        me = client.me
         about_text = (
             "<b><blockquote>⍟───[  <a href='https://t.me/PrimeXBots'>ᴍʏ ᴅᴇᴛᴀɪʟꜱ ʙʏ ᴘʀɪᴍᴇXʙᴏᴛꜱ</a> ]───⍟</blockquote></b>\n\n"
             f"‣ ᴍʏ ɴᴀᴍᴇ : <a href='https://t.me/{me.username}'>{me.first_name}</a>\n"
@@ -257,7 +1815,9 @@ async def cb_handler(client, query):
             "➌ <code>/show_source</code> – View or remove the current source\n"
             "➍ <code>/show_destiny</code> – View/manage all your destinations\n"
             "➎ <code>/stats</code> – View total users, sources & destinations (Owner only)\n"
-            "➏ <code>/broadcast</code> <i>your message</i> – Send a broadcast to all users (Owner only)\n\n"
+            "➏ <code>/broadcast</code> <i>your message</i> – Send a broadcast to all users (Owner only)\n"
+            "➐ <code>/backfill</code> <i>from_id to_id</i> – Copy older posts of your source to your destinations\n"
+            "➑ <code>/rules</code> – Filter or rewrite posts per destination\n\n"
             "⚡ After setting a source, new posts from it will automatically be forwarded to your destinations."
         )
 
@@ -275,8 +1835,8 @@ async def cb_handler(client, query):
     elif query.data.startswith("show_dest_info_"):
         chat_id = int(query.data.split("_")[-1])
         try:
-            chat = await client.get_chat(chat_id)
-            invite_link = getattr(chat, 'invite_link', None) or "No invite link available."
+            chat = await get_chat_cached(client, chat_id)
+            invite_link = chat.invite_link or "No invite link available."
             chat_type_str = chat.type.value.capitalize()
             text = f"🎯 <b>Destination Details:</b>\n" \
                    f"• <b>Name:</b> {chat.title}\n" \
@@ -293,7 +1853,7 @@ async def cb_handler(client, query):
             await query.message.edit_text(f"⚠️ Error fetching chat info for {chat_id}: {e}", parse_mode=ParseMode.HTML)
 
     elif query.data == "show_dest_list":
-        await show_destiny_list(client, query.message, edit_message=True)
+        await show_destiny_list(client, query.message, edit_message=True, user_id=user_id)
         
     elif query.data.startswith("del_dest_confirm_"):
         chat_id = int(query.data.split("_")[-1])
@@ -301,7 +1861,7 @@ async def cb_handler(client, query):
 
     # chat_info নিয়ে আসা
         try:
-            chat_info = await client.get_chat(chat_id)
+            chat_info = await get_chat_cached(client, chat_id)
             chat_name = chat_info.title
         except Exception:
             chat_name = str(chat_id)  # fallback যদি চ্যানেল info fetch না হয়
@@ -310,7 +1870,7 @@ async def cb_handler(client, query):
 
     # custom_text দিয়ে লিস্ট দেখানো হবে
         custom_text = f"✅ Destination removed: <b>{chat_name}</b>"
-        await show_destiny_list(client, query.message, edit_message=True, custom_text=custom_text)
+        await show_destiny_list(client, query.message, edit_message=True, custom_text=custom_text, user_id=user_id)
     
     
     elif query.data == "del_source_confirm":
@@ -321,6 +1881,7 @@ async def cb_handler(client, query):
 
 # 🔹 Source Prime callback
 @app.on_callback_query(filters.regex("^source_prime$"))
+@instrumented("source_info_callback")
 async def source_info_callback(client, callback_query):
     try:
         await client.send_photo(
@@ -346,6 +1907,7 @@ async def source_info_callback(client, callback_query):
 
 # 🔹 নতুন close হ্যান্ডলার (source_close)
 @app.on_callback_query(filters.regex("^source_close$"))
+@instrumented("source_close_handler")
 async def source_close_handler(client, callback_query):
     try:
         await callback_query.message.delete()
@@ -357,6 +1919,7 @@ async def source_close_handler(client, callback_query):
         
 # ---------- SET SOURCE / DESTINY ----------
 @app.on_message(filters.command("set_source") & filters.private)
+@instrumented("set_source")
 async def set_source(client, message):
     await message.reply_text(
         "📢 Please forward a message from your source channel here.\n\n⚠️ Bot must be admin in that channel.",
@@ -364,8 +1927,9 @@ async def set_source(client, message):
     )
 
 @app.on_message(filters.command("set_destiny") & filters.private)
+@instrumented("set_destiny")
 async def set_destiny(client, message):
-    waiting_for_destiny.add(message.from_user.id)
+    await state_store.set(message.from_user.id, "destiny")
     await message.reply_text(
         "🎯 Please forward a message from your destination channel/group.\n\n⚠️ Bot must be admin there.",
         parse_mode=ParseMode.HTML
@@ -373,6 +1937,7 @@ async def set_destiny(client, message):
 
 # ---------- CATCH FORWARDED ----------
 @app.on_message(filters.forwarded & filters.private)
+@instrumented("catch_forwarded")
 async def catch_forwarded(client, message):
     user_id = message.from_user.id
     if not message.forward_from_chat:
@@ -402,44 +1967,43 @@ async def catch_forwarded(client, message):
             )
         except RPCError as e:
             return await message.reply_text(f"⚠️ Telegram API error: {e}", parse_mode=ParseMode.HTML)
+        await mark_chat_healthy(chat.id)
 
-        chat_info = await client.get_chat(chat.id)
-
-        if user_id in waiting_for_destiny:
-            user_data = await get_user_data(user_id)
+        chat_info = await get_chat_cached(client, chat.id)
 
-            # 🔹 এখানে ফিক্স: get() ব্যবহার করা হয়েছে
-            dest_list = user_data.get("destination_chats", [])
-
-            if chat.id not in dest_list:
-                await add_destination(user_id, chat.id)
+        state = await state_store.get(user_id)
+        if state and state["state"] == "destiny":
+            # $addToSet ignores duplicates; the previous document tells us whether it was new
+            if await add_destination(user_id, chat.id):
                 await message.reply_text(f"✅ Destination set: {chat_info.title}", parse_mode=ParseMode.HTML)
             else:
                 await message.reply_text(f"ℹ️ This destination is already added: {chat_info.title}", parse_mode=ParseMode.HTML)
 
-            waiting_for_destiny.discard(user_id)
+            await state_store.clear(user_id)
         else:
             await update_user_data(user_id, "source_chat", chat.id)
             await message.reply_text(f"✅ Source Channel Set: {chat_info.title}", parse_mode=ParseMode.HTML)
 
     except Exception as e:
-        waiting_for_destiny.discard(user_id)
+        await state_store.clear(user_id)
         await message.reply_text(f"⚠️ Error: {e}", parse_mode=ParseMode.HTML)
 
 
 # ---------- SHOW DESTINY LIST ----------
-async def show_destiny_list(client, message, edit_message=False, custom_text=None):
-    user_data = await get_user_data(message.from_user.id)
+async def show_destiny_list(client, message, edit_message=False, custom_text=None, user_id=None):
+    # from a callback, message is the bot's own message, so the caller passes the user's id
+    user_data = await get_user_data(user_id or message.from_user.id)
     dests = user_data.get("destination_chats", [])
 
     if dests:
         text = custom_text or "🎯 Select a destination to manage:\n"
         buttons = []
-        for d_chat_id in dests:
-            try:
-                chat = await client.get_chat(d_chat_id)
+        # cache misses are fetched concurrently instead of one get_chat after another
+        chats = await asyncio.gather(*(get_chat_cached(client, d_chat_id) for d_chat_id in dests), return_exceptions=True)
+        for d_chat_id, chat in zip(dests, chats):
+            if not isinstance(chat, Exception):
                 buttons.append([InlineKeyboardButton(chat.title, callback_data=f"show_dest_info_{d_chat_id}")])
-            except Exception:
+            else:
                 buttons.append([InlineKeyboardButton(f"Unknown Chat ({d_chat_id})", callback_data=f"show_dest_info_{d_chat_id}")])
         reply_markup = InlineKeyboardMarkup(buttons)
         if edit_message:
@@ -455,16 +2019,18 @@ async def show_destiny_list(client, message, edit_message=False, custom_text=Non
             await message.reply_text(text, parse_mode=ParseMode.HTML)
 
 @app.on_message(filters.command("show_destiny") & filters.private)
+@instrumented("show_destiny_command")
 async def show_destiny_command(client, message):
     await show_destiny_list(client, message)
 
 @app.on_message(filters.command("show_source") & filters.private)
+@instrumented("show_source")
 async def show_source(client, message):
     user_data = await get_user_data(message.from_user.id)
     src = user_data.get("source_chat")
     if src:
         try:
-            chat = await client.get_chat(src)
+            chat = await get_chat_cached(client, src)
             buttons = InlineKeyboardMarkup([
                 [InlineKeyboardButton("❌ Remove Source", callback_data="del_source_confirm")]
             ])
@@ -474,56 +2040,242 @@ async def show_source(client, message):
     else:
         await message.reply_text("⚠️ No source set. Use /set_source to add one.", parse_mode=ParseMode.HTML)
 
+# ---------- RULES ----------
+RULES_USAGE = (
+    "🎛 <b>Rules per destination</b>\n\n"
+    "<code>/rules</code> – Show your rules\n"
+    "<code>/rules dest_id include word, other words</code> – Only posts containing one of them\n"
+    "<code>/rules dest_id exclude word, ...</code> – Skip posts containing any of them\n"
+    "<code>/rules dest_id media photo, video</code> – Only these types (" + ", ".join(RULE_MEDIA) + ")\n"
+    "<code>/rules dest_id strip_links on|off</code> – Remove links from texts and captions\n"
+    "<code>/rules dest_id replace old => new</code> – Rewrite texts and captions\n"
+    "<code>/rules dest_id clear</code> – Remove all rules of a destination\n\n"
+    "Sending include, exclude, media or replace without values removes that rule."
+)
+
+def describe_rule(rule):
+    lines = []
+    for kind in ("include", "exclude", "media"):
+        if rule.get(kind):
+            lines.append(f"{kind}: {html.escape(', '.join(rule[kind]))}")
+    if rule.get("strip_links"):
+        lines.append("strip links: on")
+    for old, new in rule.get("replace") or []:
+        lines.append(f"replace: {html.escape(old)} → {html.escape(new)}")
+    return "\n".join(lines)
+
+@app.on_message(filters.command("rules") & filters.private)
+@instrumented("rules_cmd")
+async def rules_cmd(client, message):
+    user_id = message.from_user.id
+    user_data = await get_user_data(user_id)
+    rules = user_data.get("rules") or {}
+    args = message.text.split(None, 3)
+    if len(args) == 1:
+        if not rules:
+            return await message.reply_text(RULES_USAGE, parse_mode=ParseMode.HTML)
+        text = "\n\n".join(f"🎯 <code>{dest}</code>\n{describe_rule(rule)}" for dest, rule in rules.items())
+        return await message.reply_text(text, parse_mode=ParseMode.HTML)
+
+    try:
+        dest, kind = int(args[1]), args[2].lower()
+    except (IndexError, ValueError):
+        return await message.reply_text(RULES_USAGE, parse_mode=ParseMode.HTML)
+    if dest not in user_data.get("destination_chats", []):
+        return await message.reply_text("⚠️ That chat is not one of your destinations. See /show_destiny.", parse_mode=ParseMode.HTML)
+    value = args[3].strip() if len(args) > 3 else ""
+    rule = dict(rules.get(str(dest)) or {})
+
+    if kind in ("include", "exclude", "media"):
+        items = [v.strip() for v in value.split(",") if v.strip()]
+        if kind == "media":
+            items = [v.lower() for v in items]
+            unknown = [v for v in items if v not in RULE_MEDIA]
+            if unknown:
+                return await message.reply_text(f"⚠️ Unknown media type: {html.escape(', '.join(unknown))}", parse_mode=ParseMode.HTML)
+        rule[kind] = items
+    elif kind == "strip_links":
+        if value.lower() not in ("on", "off"):
+            return await message.reply_text(RULES_USAGE, parse_mode=ParseMode.HTML)
+        rule[kind] = value.lower() == "on"
+    elif kind == "replace":
+        if value and "=>" not in value:
+            return await message.reply_text(RULES_USAGE, parse_mode=ParseMode.HTML)
+        if value:
+            old, new = (part.strip() for part in value.split("=>", 1))
+            if not old:
+                return await message.reply_text(RULES_USAGE, parse_mode=ParseMode.HTML)
+            rule[kind] = [r for r in rule.get(kind, []) if r[0] != old] + [[old, new]]
+        else:
+            rule[kind] = []
+    elif kind == "clear":
+        rule = {}
+    else:
+        return await message.reply_text(RULES_USAGE, parse_mode=ParseMode.HTML)
+
+    rule = {k: v for k, v in rule.items() if v}
+    await set_rule(user_id, dest, rule)
+    if rule:
+        await message.reply_text(f"✅ Rules for <code>{dest}</code>:\n{describe_rule(rule)}", parse_mode=ParseMode.HTML)
+    else:
+        await message.reply_text(f"✅ No rules left for <code>{dest}</code>, every post is copied.", parse_mode=ParseMode.HTML)
+
 # ---------- STATUS & BROADCAST ----------
 @app.on_message(filters.command("stats") & filters.user(OWNER_ID))
+@instrumented("status_cmd")
 async def status_cmd(client, message):
-    total_users = await users_collection.count_documents({})
-    total_sources = await users_collection.count_documents({"source_chat": {"$ne": None}})
-    pipeline = [{"$unwind": "$destination_chats"},
-                {"$group": {"_id": None, "total": {"$sum": 1}}}]
-    dest_agg = await users_collection.aggregate(pipeline).to_list(None)
-    total_destinations = dest_agg[0]["total"] if dest_agg else 0
+    # "/stats recount" rebuilds the counters from a full scan if they ever drift
+    if len(message.command) > 1 and message.command[1] == "recount":
+        await seed_totals(rebuild=True)
+    docs = {d["_id"]: d async for d in stats_collection.find({"_id": {"$in": ["totals", day_key()]}})}
+    totals = docs.get("totals", {})
+    today = docs.get(day_key(), {})
     await message.reply_text(
-        f"👤 Total Users: <b>{total_users}</b>\n"
-        f"📢 Sources Set: <b>{total_sources}</b>\n"
-        f"🎯 Destinations Added: <b>{total_destinations}</b>",
+        f"👤 Total Users: <b>{totals.get('users', 0)}</b>\n"
+        f"📢 Sources Set: <b>{totals.get('sources', 0)}</b>\n"
+        f"🎯 Destinations Added: <b>{totals.get('destinations', 0)}</b>\n"
+        f"📤 Forwarded Today: <b>{today.get('sent', 0)}</b> (failed: {today.get('failed', 0)})",
         parse_mode=ParseMode.HTML
     )
 
-@app.on_message(filters.command("broadcast") & filters.user(OWNER_ID))
-async def broadcast_cmd(client, message):
-    if len(message.command) < 2:
-        return await message.reply_text("Usage: /broadcast your message")
-    text = message.text.split(" ", 1)[1]
+# Broadcasts stream user ids (ids only) from Mongo in _id order through a fixed pool of
+# senders. After every batch the last _id and the counters are saved, so a broadcast that
+# was interrupted by a restart continues where it stopped. Users who blocked the bot are
+# flagged with blocked=True and skipped by later broadcasts until they /start again.
+BROADCAST_WORKERS = int(environ.get("BROADCAST_WORKERS", 20))
+BROADCAST_BATCH = 200  # users per checkpoint
+BROADCAST_STATUS_INTERVAL = 5  # seconds between status message edits
+broadcast_tasks = set()
 
-    count = 0
-    failed = 0
-    tasks = []
+async def broadcast_send(client, uid, text, retries=3):
+    # returns "sent", "blocked" or "failed"
+    for attempt in range(retries):
+        try:
+            async with lane_slots["bulk"]:
+                await throttle(uid, "bulk")
+                await client.send_message(uid, text, parse_mode=ParseMode.HTML)
+            metrics.inc("telegram_requests_total", method="send_message", outcome="ok")
+            return "sent"
+        except FloodWait as e:
+            wait = record_flood_wait(e)
+            logger.warning(f"FloodWait: sleeping for {wait} seconds before retrying broadcast to {uid}")
+            await flood_sleep(wait + 1)
+        except (UserIsBlocked, InputUserDeactivated, UserIsBot, PeerIdInvalid) as e:
+            metrics.inc("telegram_requests_total", method="send_message", outcome="error")
+            logger.info(f"Cannot send broadcast to {uid}: {e}")
+            return "blocked"
+        except Exception as e:
+            metrics.inc("telegram_requests_total", method="send_message", outcome="error")
+            logger.warning(f"Failed to send broadcast to {uid} on attempt {attempt+1}: {e}")
+            await asyncio.sleep(1)
+    return "failed"
+
+def broadcast_status_text(job, finished=False):
+    head = "✅ Broadcast finished." if finished else "📣 Broadcast in progress..."
+    return (
+        f"{head}\n\n"
+        f"✅ Sent: <b>{job['sent']}</b>\n"
+        f"🚫 Blocked: <b>{job['blocked']}</b>\n"
+        f"⚠️ Failed: <b>{job['failed']}</b>"
+    )
 
-    async for user_data in users_collection.find({}):
-        uid = user_data.get("_id")
-        if not isinstance(uid, int):
+async def update_broadcast_status(client, job, finished=False):
+    try:
+        await client.edit_message_text(job["status_chat"], job["status_msg"], broadcast_status_text(job, finished), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.info(f"Could not update broadcast status: {e}")
+
+async def run_broadcast(client, job):
+    queue = asyncio.Queue()
+    newly_blocked = []
+
+    async def sender():
+        while True:
+            uid = await queue.get()
             try:
-                uid = int(uid)
-            except (ValueError, TypeError):
-                logger.warning(f"Invalid user ID found in DB: {uid}")
-                continue
-        tasks.append(asyncio.create_task(send_with_retry(client, uid, text)))
+                result = await broadcast_send(client, uid, job["text"])
+                job[result] += 1
+                if result == "blocked":
+                    newly_blocked.append(uid)
+            except Exception:
+                job["failed"] += 1
+                logger.exception(f"Broadcast to {uid} failed")
+            finally:
+                queue.task_done()
 
-    if not tasks:
-        return await message.reply_text("ℹ️ No users found in database to broadcast.")
+    async def checkpoint(last_id):
+        if newly_blocked:
+            await users_collection.update_many({"_id": {"$in": newly_blocked}}, {"$set": {"blocked": True}})
+            newly_blocked.clear()
+        job["last_id"] = last_id
+        await broadcasts_collection.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"last_id": last_id, "sent": job["sent"], "failed": job["failed"], "blocked": job["blocked"]}}
+        )
 
-    results = await asyncio.gather(*tasks)
-    for r in results:
-        if r is None:
-            failed += 1
-        else:
-            count += 1
+    senders = [asyncio.create_task(sender()) for _ in range(BROADCAST_WORKERS)]
+    query = {"blocked": {"$ne": True}}
+    if job.get("last_id") is not None:
+        query["_id"] = {"$gt": job["last_id"]}
+    last_status = time.monotonic()
+    try:
+        pending = 0
+        last_id = None
+        async for user_data in users_collection.find(query, {"_id": 1}).sort("_id", 1).batch_size(BROADCAST_BATCH):
+            last_id = user_data["_id"]
+            uid = last_id
+            if not isinstance(uid, int):
+                try:
+                    uid = int(uid)
+                except (ValueError, TypeError):
+                    logger.warning(f"Invalid user ID found in DB: {uid}")
+                    continue
+            queue.put_nowait(uid)
+            pending += 1
+            if pending >= BROADCAST_BATCH:
+                await queue.join()
+                await checkpoint(last_id)
+                pending = 0
+                if time.monotonic() - last_status >= BROADCAST_STATUS_INTERVAL:
+                    await update_broadcast_status(client, job)
+                    last_status = time.monotonic()
+        await queue.join()
+        if last_id is not None:
+            await checkpoint(last_id)
+        await broadcasts_collection.update_one({"_id": job["_id"]}, {"$set": {"status": "done"}})
+        await update_broadcast_status(client, job, finished=True)
+    finally:
+        for task in senders:
+            task.cancel()
 
-    await message.reply_text(f"✅ Broadcast sent to {count} users. Failed: {failed}")
+def start_broadcast_task(client, job):
+    task = asyncio.create_task(in_lane("bulk", run_broadcast(client, job)))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+async def resume_broadcasts(client):
+    async for job in broadcasts_collection.find({"status": "running"}):
+        logger.info(f"Resuming broadcast {job['_id']} after user {job.get('last_id')}")
+        start_broadcast_task(client, job)
+
+@app.on_message(filters.command("broadcast") & filters.user(OWNER_ID))
+@instrumented("broadcast_cmd")
+async def broadcast_cmd(client, message):
+    if len(message.command) < 2:
+        return await message.reply_text("Usage: /broadcast your message")
+    text = message.text.split(" ", 1)[1]
+
+    job = {"text": text, "status": "running", "last_id": None, "sent": 0, "failed": 0, "blocked": 0,
+           "created": datetime.now(timezone.utc)}
+    status = await message.reply_text(broadcast_status_text(job), parse_mode=ParseMode.HTML)
+    job["status_chat"] = status.chat.id
+    job["status_msg"] = status.id
+    await broadcasts_collection.insert_one(job)
+    start_broadcast_task(client, job)
 
 # 🟢 Subscription refresh
 @Client.on_callback_query(filters.regex("refresh_check"))
+@instrumented("refresh_callback")
 async def refresh_callback(client, query):
     btn = await is_subscribed(client, query.from_user.id, AUTH_CHANNEL)
     if not btn:
@@ -538,56 +2290,368 @@ async def refresh_callback(client, query):
             show_alert=True
         )
 
+# ---------- BACKFILL ----------
+# /backfill copies a range of older source posts. Ids are fetched BACKFILL_CHUNK at a time with
+# one get_messages call, gaps (deleted or service messages) are dropped, and the rest is queued as
+# batch jobs at backfill priority, so live posts always go first. Progress is checkpointed per
+# (source, destination) in the backfills collection and unfinished backfills resume on startup.
+BACKFILL_CHUNK = 200  # ids per get_messages call
+BACKFILL_MAX_PENDING = 50  # queued batch jobs per source before fetching more
+BACKFILL_MAX_RANGE = int(environ.get("BACKFILL_MAX_RANGE", 10000))  # ids per /backfill
+backfill_tasks = set()
+active_backfills = set()  # (user_id, source) with a backfill task in this process
+
+async def fetch_messages(client, chat_id, message_ids):
+    while True:
+        try:
+            return await client.get_messages(chat_id, message_ids)
+        except FloodWait as e:
+            await flood_sleep(record_flood_wait(e) + 1)
+
+async def run_backfill(client, source, checkpoints):
+    # checkpoints: backfill documents of one source, one per destination
+    start = min(c["next_id"] for c in checkpoints)
+    end = max(c["to_id"] for c in checkpoints)
+    try:
+        for chunk_start in range(start, end + 1, BACKFILL_CHUNK):
+            chunk_end = min(chunk_start + BACKFILL_CHUNK - 1, end)
+            pending = {"partition": partition_of(source), "priority": 1, "source": source}
+            while await outbox_collection.count_documents(pending) >= BACKFILL_MAX_PENDING:
+                await asyncio.sleep(5)
+            messages = await fetch_messages(client, source, list(range(chunk_start, chunk_end + 1)))
+            found = [m for m in messages if m and not m.empty and not m.service]
+            ruleset = get_ruleset(source)
+
+            for c in checkpoints:
+                # hidden forwards cannot rewrite posts, so only the filters of a rule apply here
+                route = [(c["user_id"], c["dest"])]
+                ids = [m.id for m in found if c["next_id"] <= m.id <= c["to_id"] and (not ruleset or ruleset.apply([m], route))]
+                await enqueue_batch(source, ids, [(c["user_id"], c["dest"])], priority=1)
+            for c in checkpoints:
+                if c["next_id"] <= chunk_end:
+                    c["next_id"] = chunk_end + 1
+                    done = c["next_id"] > c["to_id"]
+                    await backfills_collection.update_one({"_id": c["_id"]}, {"$set": {"next_id": c["next_id"], "status": "done" if done else "running"}})
+    except Exception as e:
+        # cancellation on shutdown is not caught and leaves the run to be resumed; anything else
+        # (source gone private, bot removed, Mongo down) would fail the same way on every boot
+        logger.exception(f"Backfill of {source} failed")
+        unfinished = [c for c in checkpoints if c["next_id"] <= c["to_id"]]
+        await backfills_collection.update_many({"_id": {"$in": [c["_id"] for c in unfinished]}}, {"$set": {"status": "failed", "error": str(e)}})
+        for user_id in {c["user_id"] for c in unfinished}:
+            left = [c for c in unfinished if c["user_id"] == user_id]
+            resume = f"/backfill {min(c['next_id'] for c in left)} {max(c['to_id'] for c in left)}"
+            await send_with_retry(client, user_id, f"❌ Backfill of messages {start}–{end} stopped: <code>{html.escape(str(e))}</code>\n\nCheck that the bot can still read the source, then continue with <code>{resume}</code>.", parse_mode=ParseMode.HTML)
+        return
+
+    user_ids = {c["user_id"] for c in checkpoints}
+    for user_id in user_ids:
+        await send_with_retry(client, user_id, f"✅ Backfill of messages {start}–{end} is queued. Posts will arrive in your destinations shortly.", parse_mode=ParseMode.HTML)
+
+def start_backfill_task(client, source, checkpoints):
+    keys = {(c["user_id"], source) for c in checkpoints}
+    active_backfills.update(keys)
+    task = asyncio.create_task(in_lane("bulk", run_backfill(client, source, checkpoints)))
+    backfill_tasks.add(task)
+    task.add_done_callback(backfill_tasks.discard)
+    task.add_done_callback(lambda _: active_backfills.difference_update(keys))
+
+async def resume_backfills(client):
+    by_source = {}
+    async for c in backfills_collection.find({"status": "running"}):
+        by_source.setdefault(c["source"], []).append(c)
+    for source, checkpoints in by_source.items():
+        logger.info(f"Resuming backfill of {source} for {len(checkpoints)} destination(s)")
+        start_backfill_task(client, source, checkpoints)
+
+@app.on_message(filters.command("backfill") & filters.private)
+@instrumented("backfill_cmd")
+async def backfill_cmd(client, message):
+    try:
+        from_id, to_id = int(message.command[1]), int(message.command[2])
+    except (IndexError, ValueError):
+        return await message.reply_text("Usage: /backfill from_id to_id\n\nExample: <code>/backfill 1 500</code>", parse_mode=ParseMode.HTML)
+    if from_id < 1 or to_id < from_id:
+        return await message.reply_text("⚠️ from_id must be at least 1 and not greater than to_id.", parse_mode=ParseMode.HTML)
+    if to_id - from_id + 1 > BACKFILL_MAX_RANGE:
+        return await message.reply_text(f"⚠️ A backfill can cover at most {BACKFILL_MAX_RANGE} messages. Split the range into several runs.", parse_mode=ParseMode.HTML)
+
+    user_id = message.from_user.id
+    user_data = await get_user_data(user_id)
+    source = user_data.get("source_chat")
+    dests = user_data.get("destination_chats", [])
+    if not source or not dests:
+        return await message.reply_text("⚠️ Set a source with /set_source and at least one destination with /set_destiny first.", parse_mode=ParseMode.HTML)
+
+    # a second run over the same checkpoints would queue every post twice
+    key = (user_id, source)
+    if key in active_backfills or await backfills_collection.find_one({"user_id": user_id, "source": source, "status": "running"}):
+        return await message.reply_text("⚠️ A backfill of this source is already running. Wait for it to finish first.", parse_mode=ParseMode.HTML)
+    active_backfills.add(key)
+
+    checkpoints = []
+    try:
+        for dest in dests:
+            c = {"_id": f"{user_id}:{source}:{dest}", "source": source, "dest": dest, "user_id": user_id,
+                 "from_id": from_id, "to_id": to_id, "next_id": from_id, "status": "running"}
+            await backfills_collection.replace_one({"_id": c["_id"]}, c, upsert=True)
+            checkpoints.append(c)
+    except BaseException:
+        active_backfills.discard(key)
+        raise
+    start_backfill_task(client, source, checkpoints)
+    await message.reply_text(f"⏳ Backfill started: messages {from_id}–{to_id} to {len(dests)} destination(s).", parse_mode=ParseMode.HTML)
+
 # ---------- FORWARDER ----------
 @app.on_message(filters.channel)
+@instrumented("forward_message", lane="live")
 async def forward_message(client, message):
-    # limit concurrency for copies
-    sem = asyncio.Semaphore(5)
-    async for user_data in users_collection.find({"source_chat": message.chat.id}):
-        user_id = user_data["_id"]
-        destinations = user_data.get("destination_chats", [])
-        for dest_chat_id in destinations:
-            try:
-                await copy_with_retry(client, dest_chat_id, message.chat.id, message.id, semaphore=sem)
-            except Exception as e:
+    metrics.inc("channel_posts_total")
+    routes = live_routes(message.chat.id)
+    if not routes:
+        return  # nobody forwards from this channel, or every destination is unreachable
+    ruleset = get_ruleset(message.chat.id)
+    if ruleset and not message.media_group_id:
+        # each post can go to different destinations, so these are never coalesced into bursts
+        routes = ruleset.apply([message], routes)
+        if routes:
+            await enqueue_forwards(message.chat.id, message.id, routes)
+        else:
+            metrics.inc("posts_filtered_total")
+        return
+    if BURST_WINDOW > 0 and not ruleset:
+        buffer_burst_item(message)
+        return
+    if message.media_group_id:
+        buffer_album_item(message)
+        return
+    await enqueue_forwards(message.chat.id, message.id, routes)
+
+# ---------- EDITS & DELETIONS ----------
+# Edits and deletions in a source are applied to the copies recorded in the message map.
+async def _edit_copy(client, message, dest, dest_id, override=None):
+    # override is the rewritten text or caption when the destination has rules
+    if message.text:
+        text = override[1] if override else message.text.html
+        call = lambda: client.edit_message_text(dest, dest_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=not message.web_page)
+    elif message.caption is not None:
+        caption = override[1] if override else message.caption.html
+        call = lambda: client.edit_message_caption(dest, dest_id, caption, parse_mode=ParseMode.HTML)
+    else:
+        return  # media replacements are not mirrored
+    try:
+        await call_with_retry(dest, call, method="edit_message")
+    except Exception as e:
+        logger.info(f"Could not mirror edit of {message.chat.id}/{message.id} to {dest}: {e}")
+
+@app.on_edited_message(filters.channel)
+@instrumented("mirror_edit", lane="live")
+async def mirror_edit(client, message):
+    copies = await lookup_copies(message.chat.id, [message.id])
+    targets = copies.get(message.id)
+    if not targets:
+        return
+    overrides = {}
+    ruleset = get_ruleset(message.chat.id)
+    if ruleset and message.media_group_id:
+        # an album was judged as a whole when it was sent, so one edited item is only rewritten
+        for _, dest, override in ruleset.apply([message], get_routes(message.chat.id), album=True, filters=False):
+            if override and override[1][0] is not None:
+                overrides[dest] = ("caption", override[1][0])
+    elif ruleset:
+        # copies whose post no longer passes the rules keep their last version
+        overrides = {dest: override for _, dest, override in ruleset.apply([message], get_routes(message.chat.id))}
+        targets = [(dest, dest_id) for dest, dest_id in targets if dest in overrides]
+    spawn("live", asyncio.gather(*(_edit_copy(client, message, dest, dest_id, overrides.get(dest)) for dest, dest_id in targets)))
+
+@app.on_deleted_messages(filters.channel)
+@instrumented("mirror_delete", lane="live")
+async def mirror_delete(client, messages):
+    by_source = {}
+    for message in messages:
+        if message.chat:
+            by_source.setdefault(message.chat.id, []).append(message.id)
+    for source, message_ids in by_source.items():
+        copies = await lookup_copies(source, message_ids)
+        if not copies:
+            continue
+        by_dest = {}
+        for targets in copies.values():
+            for dest, dest_id in targets:
+                by_dest.setdefault(dest, []).append(dest_id)
+
+        async def delete(dest, dest_ids):
+            for i in range(0, len(dest_ids), FORWARD_BATCH):
+                chunk = dest_ids[i:i + FORWARD_BATCH]
                 try:
-                    await client.send_message(user_id, f"⚠️ Could not forward to destination (ID: <code>{dest_chat_id}</code>). Error: {e}", parse_mode=ParseMode.HTML)
-                except Exception:
-                    pass
-
-# ---------- STARTUP CHECKS ----------
-async def startup_checks(client):
-    # verify bot is still member/admin in stored chats and report to owner if issues
-    logger.info("Running startup checks for stored chats...")
-    bad_chats = []
-    checked = set()
-    async for user_data in users_collection.find({}):
-        src = user_data.get("source_chat")
-        dests = user_data.get("destination_chats", [])
-        candidates = []
-        if src:
-            candidates.append(src)
-        candidates.extend(dests)
-        for chat_id in candidates:
-            if chat_id in checked:
+                    await call_with_retry(dest, lambda: client.delete_messages(dest, chunk), method="delete_messages")
+                except Exception as e:
+                    logger.info(f"Could not mirror deletion in {dest}: {e}")
+
+        spawn("live", asyncio.gather(*(delete(dest, dest_ids) for dest, dest_ids in by_dest.items())))
+        await forget_copies(source, list(copies))
+
+# ---------- ACCESS AUDIT ----------
+# Every AUDIT_INTERVAL the bot checks that it can still reach each distinct source and
+# destination. Results are stored in chat_health; destinations it lost access to are kept in
+# dead_chats and skipped by forward_message until a later audit (or re-adding them) clears them.
+AUDIT_INTERVAL = int(environ.get("AUDIT_INTERVAL", 6 * 3600))  # seconds
+AUDIT_CONCURRENCY = int(environ.get("AUDIT_CONCURRENCY", 10))  # chats checked at once
+AUDIT_FIRST_DELAY = 60  # seconds after startup
+dead_chats = set()
+
+def live_routes(source_chat):
+    return [(user_id, dest) for user_id, dest in get_routes(source_chat) if dest not in dead_chats]
+
+async def load_chat_health():
+    dead_chats.clear()
+    async for doc in chat_health_collection.find({"ok": False}, {"_id": 1}):
+        dead_chats.add(doc["_id"])
+
+async def mark_chat_healthy(chat_id):
+    if chat_id in dead_chats:
+        dead_chats.discard(chat_id)
+        await chat_health_collection.update_one(
+            {"_id": chat_id}, {"$set": {"ok": True, "error": None, "checked_at": datetime.now(timezone.utc)}}, upsert=True
+        )
+
+ACCESS_UNKNOWN = object()  # the check itself failed; the chat keeps its previous verdict
+
+async def check_chat_access(client, chat_id):
+    # returns None when the bot can use the chat, a reason when it cannot, or ACCESS_UNKNOWN
+    for attempt in range(2):
+        try:
+            member = await client.get_chat_member(chat_id, client.me.id)
+        except FloodWait as e:
+            await flood_sleep(record_flood_wait(e) + 1)
+            continue
+        except Exception as e:
+            # a 4xx means Telegram answered about this chat; timeouts and 5xx say nothing
+            if classify_error(e) in ("permanent", "rejected"):
+                return str(e)
+            logger.info(f"Could not check access to {chat_id}: {e}")
+            return ACCESS_UNKNOWN
+        if member.status in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED):
+            return f"bot status is {member.status.value}"
+        return None
+    return ACCESS_UNKNOWN  # still flood limited
+
+async def audit_chats(client):
+    logger.info("Running access audit for stored chats...")
+    chat_ids = set(await users_collection.distinct("source_chat"))
+    chat_ids |= set(await users_collection.distinct("destination_chats"))
+    chat_ids.discard(None)
+    chat_ids = list(chat_ids)
+
+    lost, recovered = [], []
+    now = datetime.now(timezone.utc)
+    for i in range(0, len(chat_ids), AUDIT_CONCURRENCY):
+        batch = chat_ids[i:i + AUDIT_CONCURRENCY]
+        errors = await asyncio.gather(*(check_chat_access(client, chat_id) for chat_id in batch))
+        ops = []
+        for chat_id, err in zip(batch, errors):
+            if err is ACCESS_UNKNOWN:
                 continue
-            checked.add(chat_id)
-            try:
-                await client.get_chat_member(chat_id, client.me.id)
-            except Exception as e:
-                logger.warning(f"Bot not member/admin or cannot access chat {chat_id}: {e}")
-                bad_chats.append((chat_id, str(e)))
-
-    if bad_chats:
-        text = "⚠️ Startup check found chats where bot may not have access or admin rights:\n"
-        for cid, err in bad_chats[:50]:
-            text += f"• ID {cid}: {err}\n"
+            ops.append(UpdateOne({"_id": chat_id}, {"$set": {"ok": err is None, "error": err, "checked_at": now}}, upsert=True))
+            if err is not None and chat_id not in dead_chats:
+                logger.warning(f"Bot not member/admin or cannot access chat {chat_id}: {err}")
+                dead_chats.add(chat_id)
+                lost.append((chat_id, err))
+            elif err is None and chat_id in dead_chats:
+                dead_chats.discard(chat_id)
+                recovered.append(chat_id)
+        if ops:
+            await chat_health_collection.bulk_write(ops, ordered=False)
+
+    logger.info(f"Access audit done: {len(chat_ids)} chats, {len(dead_chats)} unreachable")
+    if lost or recovered:
+        # one digest of what changed since the last audit
+        text = f"🩺 Access audit: {len(chat_ids)} chats checked, {len(dead_chats)} unreachable.\n"
+        if lost:
+            text += f"\n⚠️ Lost access ({len(lost)}):\n"
+            text += "".join(f"• ID {cid}: {err}\n" for cid, err in lost[:30])
+            if len(lost) > 30:
+                text += f"…and {len(lost) - 30} more\n"
+        if recovered:
+            text += f"\n✅ Access restored ({len(recovered)}):\n"
+            text += "".join(f"• ID {cid}\n" for cid in recovered[:30])
+            if len(recovered) > 30:
+                text += f"…and {len(recovered) - 30} more\n"
+        await send_with_retry(client, OWNER_ID, text, parse_mode=None)
+
+async def audit_loop(client):
+    await asyncio.sleep(AUDIT_FIRST_DELAY)
+    while True:
         try:
-            await client.send_message(OWNER_ID, text)
+            await audit_chats(client)
         except Exception:
-            logger.exception("Could not send startup report to owner")
-    else:
-        logger.info("Startup checks passed: bot has access to stored chats.")
+            logger.exception("Access audit failed")
+        await asyncio.sleep(AUDIT_INTERVAL)
 
 # ---------- RUN ----------
-app.run()
+async def startup():
+    # returns the background tasks and the outbox workers; the bot is ready once this is done
+    await db_client.admin.command("ping")
+    await app.start()  # also sets app.me
+    await ensure_indexes()
+    tasks = [asyncio.create_task(stats_flusher()), asyncio.create_task(loop_lag_monitor()), asyncio.create_task(metrics_collector())]
+    outbox_tasks = []
+    if ROLE == "ingest":
+        _apply_rate_share()  # holds no partitions, so this is its whole budget
+    if ROLE in ("all", "ingest"):
+        await seed_totals()
+        await load_routing_index()
+        await load_chat_health()
+        tasks.append(asyncio.create_task(watch_routing_changes()))
+        tasks.append(asyncio.create_task(state_sweeper()))
+        await resume_broadcasts(app)
+        await resume_backfills(app)
+        tasks.append(asyncio.create_task(audit_loop(app)))
+    if ROLE in ("all", "worker"):
+        tasks.append(await start_partitions())
+        outbox_tasks = await start_outbox(app)
+        tasks.append(asyncio.create_task(digest_loop(app)))
+        tasks.append(asyncio.create_task(map_flusher()))
+    return tasks, outbox_tasks
+
+async def shutdown(tasks, outbox_tasks):
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    bot_ready.clear()
+    cut = 0
+    # handlers finish the updates already queued, then the dispatcher takes no more
+    if not app.no_updates:
+        if await drain([asyncio.create_task(app.dispatcher.stop())], deadline):
+            # cut off the handlers still running too and forget them, or app.stop() would stop the
+            # dispatcher again and await the worker the cancelled stop() was waiting on
+            cut += await drain(app.dispatcher.handler_worker_tasks, deadline) + 1
+            app.dispatcher.handler_worker_tasks.clear()
+    stopping.set()  # album and burst windows close early and queue what they hold
+    cut += await drain([*album_tasks, *burst_tasks, *lane_tasks], deadline)
+    outbox_closing.set()
+    outbox_wakeup.set()
+    cut += await drain(outbox_tasks, deadline)
+    if cut:
+        logger.warning(f"Shutdown deadline reached, {cut} task(s) cut off; their jobs are released")
+    # broadcasts and backfills are checkpointed and resume on the next start
+    for task in [*tasks, *broadcast_tasks, *backfill_tasks]:
+        task.cancel()
+    if ROLE in ("all", "worker"):
+        await release_jobs()
+        await release_partitions()
+        await send_failure_digests(app)
+        await flush_map_writes()
+    await flush_forward_counts()
+    await app.stop()
+
+async def main():
+    start_health_server()
+    tasks, outbox_tasks = await startup()
+    bot_ready.set()
+    logger.info(f"Bot @{app.me.username} ready (role {ROLE})")
+    await idle()
+    logger.info("Shutting down")
+    await shutdown(tasks, outbox_tasks)
+
+# importing main (e.g. from bench.py) must not start the bot
+if __name__ == "__main__":
+    app.run(main())
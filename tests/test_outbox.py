@@ -0,0 +1,198 @@
+import os
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("MONGO_DB_URL", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("AUTH_CHANNEL", "")
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from pyrogram.errors import MessageIdInvalid, InternalServerError
+
+import main as bot
+
+SOURCE = -1001000000000
+DEST = -1002000000000
+
+
+class FailingClient:
+    # hidden batch forwards go through invoke; every call fails with the given error
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def rnd_id(self):
+        return 1
+
+    async def resolve_peer(self, peer_id):
+        return peer_id
+
+    async def invoke(self, query):
+        self.calls += 1
+        raise self.error
+
+
+@pytest.fixture(autouse=True)
+def fake_db():
+    db = mongomock_motor.AsyncMongoMockClient()["autoforward_db"]
+    for name, value in list(vars(bot).items()):
+        if name.endswith("_collection"):
+            setattr(bot, name, db[value.name])
+    bot.breakers.clear()
+    bot.failure_digest.clear()
+    bot.global_bucket = bot.TokenBucket(1e9, 1e9)
+    bot.chat_buckets.clear()
+    bot.CHAT_RATE_PER_MIN = 1e9
+    yield
+
+
+async def run_batch_job(error, attempts):
+    await bot.enqueue_batch(SOURCE, [1, 2, 3], [(100, DEST)], priority=1)
+    await bot.outbox_collection.update_many({}, {"$set": {"attempts": attempts}})
+    job = await bot.outbox_collection.find_one({})
+    client = FailingClient(error)
+    await bot.process_job(client, job)
+    return await bot.outbox_collection.count_documents({})
+
+
+def test_batch_job_with_deleted_posts_is_acked():
+    left = asyncio.run(run_batch_job(MessageIdInvalid(), attempts=1))
+    assert left == 0
+    assert bot.failure_digest[100][DEST][0] == 1
+
+
+def test_batch_job_out_of_retries_is_acked():
+    left = asyncio.run(run_batch_job(InternalServerError("down"), attempts=bot.OUTBOX_MAX_ATTEMPTS))
+    assert left == 0
+
+
+def open_breaker():
+    breaker = bot.breakers.setdefault(DEST, bot.CircuitBreaker())
+    breaker.open_until = bot.time.monotonic() - 1  # cooldown over, next job probes
+
+
+def test_probe_ending_in_floodwait_or_deleted_post_does_not_stick():
+    from pyrogram.errors import FloodWait
+    for error in (FloodWait(value=60), MessageIdInvalid()):
+        open_breaker()
+        asyncio.run(run_batch_job(error, attempts=1))
+        assert bot.breaker_allows(DEST)
+        bot.breakers.clear()
+
+
+def test_post_specific_error_does_not_open_breaker():
+    from pyrogram.errors import MediaCaptionTooLong, ChatWriteForbidden
+    asyncio.run(run_batch_job(MediaCaptionTooLong(), attempts=1))
+    assert bot.breaker_allows(DEST) and DEST not in bot.breakers
+    asyncio.run(run_batch_job(ChatWriteForbidden(), attempts=1))
+    assert not bot.breaker_allows(DEST)
+
+
+def test_job_for_rate_limited_destination_is_rescheduled():
+    async def scenario():
+        bot.chat_buckets[DEST] = bot.TokenBucket(1 / 60, 1)
+        bot.chat_buckets[DEST].tokens = 0
+        await bot.enqueue_forwards(SOURCE, 1, [(100, DEST)])
+        job = await bot.outbox_collection.find_one({})
+        client = FailingClient(AssertionError("must not be sent now"))
+        started = bot.time.monotonic()
+        await bot.process_job(client, job)
+        job = await bot.outbox_collection.find_one({})
+        return bot.time.monotonic() - started, job, client.calls
+
+    elapsed, job, calls = asyncio.run(scenario())
+    assert elapsed < 1 and calls == 0
+    assert job["deferred"] and job["owner"] is None
+    bot.deferred_jobs.clear()
+
+
+class AlbumClient(FailingClient):
+    # answers SendMultiMedia with the new message ids; reading the group again would fail
+    def __init__(self):
+        super().__init__(AssertionError("album must not be read again"))
+        self.ids = iter(range(1, 100))
+        self.queries = []
+        from pyrogram.parser import Parser
+        self.parser = Parser(self)
+
+    def rnd_id(self):
+        return next(self.ids)
+
+    async def get_media_group(self, chat_id, message_id):
+        raise self.error
+
+    async def invoke(self, query):
+        from pyrogram import raw
+        self.queries.append(query)
+        return raw.types.Updates(
+            updates=[raw.types.UpdateMessageID(id=500 + m.random_id, random_id=m.random_id) for m in query.multi_media],
+            users=[], chats=[], date=0, seq=0
+        )
+
+
+def photo_message(message_id, caption):
+    from pyrogram.file_id import FileId, FileType, ThumbnailSource
+    file_id = FileId(file_type=FileType.PHOTO, dc_id=2, media_id=message_id, access_hash=1, file_reference=b"",
+                     thumbnail_source=ThumbnailSource.THUMBNAIL, thumbnail_file_type=FileType.PHOTO, thumbnail_size="y", volume_id=0, local_id=0).encode()
+    caption = caption and SimpleNamespace(html=caption)
+    return SimpleNamespace(id=message_id, media_group_id="g", photo=SimpleNamespace(file_id=file_id), video=None, document=None, audio=None, caption=caption)
+
+
+def test_album_is_sent_from_stored_media_in_one_request():
+    async def scenario():
+        album = [photo_message(11, "<b>first</b>"), photo_message(12, None)]
+        await bot.enqueue_forwards(SOURCE, 11, [(100, DEST, ("captions", ("new", None)))], album=album)
+        job = await bot.outbox_collection.find_one({})
+        client = AlbumClient()
+        await bot.process_job(client, job)
+        return client.queries, await bot.outbox_collection.count_documents({})
+
+    queries, left = asyncio.run(scenario())
+    assert len(queries) == 1 and left == 0
+    assert bot.hot_map[(SOURCE, 11)] == [(DEST, 501)] and bot.hot_map[(SOURCE, 12)] == [(DEST, 502)]
+    assert [m.message for m in queries[0].multi_media] == ["new", ""]
+
+
+def test_breaker_opened_by_outage_holds_jobs_instead_of_dropping_them():
+    from pyrogram.errors import ChatWriteForbidden
+    for _ in range(bot.BREAKER_THRESHOLD):
+        bot.breaker_failure(DEST, permanent=False)
+    left = asyncio.run(run_batch_job(AssertionError("must not be sent while open"), attempts=1))
+    assert left == 1 and not bot.failure_digest
+    bot.breakers.clear()
+    asyncio.run(bot.outbox_collection.delete_many({}))
+
+    bot.breaker_failure(DEST, permanent=True)
+    left = asyncio.run(run_batch_job(ChatWriteForbidden(), attempts=1))
+    assert left == 0 and bot.failure_digest[100][DEST][0] == 1
+
+
+def test_failed_backfill_is_marked_and_does_not_block_the_next_one():
+    from pyrogram.errors import ChannelPrivate
+
+    class SourceGone:
+        def __init__(self):
+            self.sent = []
+
+        async def get_messages(self, chat_id, message_ids):
+            raise ChannelPrivate()
+
+        async def send_message(self, chat_id, text, **kwargs):
+            self.sent.append((chat_id, text))
+
+    async def scenario():
+        c = {"_id": f"100:{SOURCE}:{DEST}", "source": SOURCE, "dest": DEST, "user_id": 100,
+             "from_id": 1, "to_id": 500, "next_id": 1, "status": "running"}
+        await bot.backfills_collection.insert_one(dict(c))
+        client = SourceGone()
+        await bot.run_backfill(client, SOURCE, [c])
+        return await bot.backfills_collection.find_one({}), client.sent
+
+    doc, sent = asyncio.run(scenario())
+    assert doc["status"] == "failed"
+    assert sent and sent[0][0] == 100 and "/backfill 1 500" in sent[0][1]
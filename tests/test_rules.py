@@ -0,0 +1,74 @@
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("MONGO_DB_URL", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("AUTH_CHANNEL", "")
+
+from pyrogram.enums import MessageMediaType
+
+import main as bot
+
+
+class Html(str):
+    # pyrogram's Str: the plain text, with the formatted version in .html
+    def __new__(cls, html):
+        text = super().__new__(cls, bot.re.sub(r"<[^>]*>", "", html))
+        text.html = html
+        return text
+
+
+def post(text=None, caption=None, media=None):
+    return SimpleNamespace(text=text and Html(text), caption=caption and Html(caption), media=media)
+
+
+def passed(rules, *messages, album=False):
+    # rules: {dest: rule document} of user 1; returns {dest: override} of the destinations the post reaches
+    ruleset = bot.RuleSet({(1, dest): rule for dest, rule in rules.items()})
+    return {dest: override for _, dest, override in ruleset.apply(list(messages), [(1, dest) for dest in rules], album=album)}
+
+
+def test_overlapping_and_prefix_keywords_are_all_found():
+    rules = {10: {"include": ["cat"]}, 11: {"include": ["catalog"]}, 12: {"include": ["log"]}, 13: {"include": ["dog"]}}
+    assert set(passed(rules, post("New CATALOG out"))) == {10, 11, 12}
+    assert bot.RuleSet({(1, 1): {"include": ["ab", "abc", "bcd"]}}).keywords_in("abcd") == {"ab", "abc", "bcd"}
+
+
+def test_include_exclude_and_media():
+    rules = {
+        10: {"include": ["sale"]},
+        11: {"include": ["sale"], "exclude": ["spam"]},
+        12: {"media": ["photo"]},
+        13: {},
+    }
+    assert set(passed(rules, post("Big SALE today"))) == {10, 11, 13}
+    assert set(passed(rules, post("sale, not spam"))) == {10, 13}
+    assert set(passed(rules, post(caption="sale", media=MessageMediaType.PHOTO))) == {10, 11, 12, 13}
+    # a link preview is still a text post
+    assert set(passed(rules, post("nothing here", media=MessageMediaType.WEB_PAGE))) == {13}
+
+
+def test_replacements_leave_markup_alone():
+    rules = {10: {"replace": [["b", "x"], ["a&b", "c<d"]]}}
+    assert passed(rules, post("<b>b a&amp;b</b>")) == {10: ("text", "<b>x c&lt;d</b>")}
+    assert passed(rules, post("nothing to change")) == {10: None}
+
+
+def test_strip_links():
+    rules = {10: {"strip_links": True}}
+    assert passed(rules, post('read <a href="https://x.y">this</a> at t.me/chan')) == {10: ("text", "read this at")}
+    # a text post that was only a link has nothing left to send
+    assert passed(rules, post("https://example.com/a")) == {}
+    # a media post keeps going without its caption
+    assert passed(rules, post(caption="www.example.com", media=MessageMediaType.PHOTO)) == {10: ("caption", "")}
+
+
+def test_album_captions_are_rewritten_per_item():
+    rules = {10: {"replace": [["old", "new"]]}, 11: {"include": ["old"]}}
+    album = [post(caption="<i>old</i> one", media=MessageMediaType.PHOTO), post(media=MessageMediaType.PHOTO),
+             post(caption="two", media=MessageMediaType.VIDEO)]
+    assert passed(rules, *album, album=True) == {10: ("captions", ("<i>new</i> one", None, "two")), 11: None}
+    unchanged = [post(caption="one", media=MessageMediaType.PHOTO), post(caption="two", media=MessageMediaType.PHOTO)]
+    assert passed(rules, *unchanged, album=True) == {10: None}